@@ -1,61 +1,751 @@
+import bz2
+import cStringIO
+import hashlib
 import httplib
+import imp
 import inspect
+import json
 import logging
+import mmap
 import threading
 import pprint
 import os
+import random
+import re
+import signal
+import shutil
 import sys
 import StringIO
+import struct
+import tempfile
+import time
+import urlparse
+import weakref
+import zlib
+from collections import deque
 from contextlib import contextmanager
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 log = logging.getLogger(__name__)
 
-__all__ = ['inject', 'Recorder', 'Player', 'FileWrapper']
+__all__ = ['inject', 'uninject', 'Recorder', 'RingRecorder', 'Player',
+           'FileWrapper', 'BlobStore', 'BlobWrapper',
+           'RecordingArchive', 'convert_recording', 'request_fingerprint',
+           'load_recording', 'preload_recordings', 'StepTable', 'Matcher',
+           'MismatchError', 'save_recording', 'BodyDigest', 'Metrics',
+           'set_instrument', 'merge_journals']
 
 
 def inject():
-    """Monkey-patch httplib with Dalton"""
-    if not hasattr(httplib.HTTPConnection, '_orig_request'):
-        httplib.HTTPConnection._orig_request = httplib.HTTPConnection.request
-        httplib.HTTPConnection._orig_getresponse = httplib.HTTPConnection.getresponse
-        httplib.HTTPConnection.request = _request
-        httplib.HTTPConnection.getresponse = _getresponse
-        httplib.HTTPConnection._intercept = _intercept
+    """Monkey-patch httplib with Dalton
+
+    The patched methods are only installed while a Recorder or Player
+    is active, the rest of the time httplib runs untouched.
+
+    """
+    with _injection_lock:
+        _injection['enabled'] = True
+        _update_patches()
+
+
+def uninject():
+    """Restore httplib and stop Dalton from monkey-patching it"""
+    with _injection_lock:
+        _injection['enabled'] = False
+        _update_patches()
+
+
+_injection_lock = threading.RLock()
+_injection = {'enabled': False, 'installed': False, 'active': 0}
+
+
+def _acquire_patches():
+    """Called when a Recorder or Player becomes active"""
+    with _injection_lock:
+        _injection['active'] += 1
+        _update_patches()
+
+
+def _release_patches():
+    """Called when a Recorder or Player is no longer active"""
+    with _injection_lock:
+        _injection['active'] -= 1
+        _update_patches()
+
+
+def _update_patches():
+    """Install or remove the httplib patches so that they're only in
+    place while injection is enabled and something is active"""
+    wanted = _injection['enabled'] and _injection['active'] > 0
+    if wanted == _injection['installed']:
+        return
+    cls = httplib.HTTPConnection
+    if wanted:
+        for name, replacement in _patched_methods():
+            original = cls.__dict__[name]
+            _originals[name] = original
+            setattr(cls, '_orig_%s' % name, original)
+            setattr(cls, name, replacement)
+        cls._intercept = _intercept_method()
+    else:
+        # Put back the very functions that were replaced, and remove
+        # what was added, so that httplib is left untouched
+        for name, replacement in _patched_methods():
+            setattr(cls, name, _originals.pop(name))
+            delattr(cls, '_orig_%s' % name)
+        del cls._intercept
+    _injection['installed'] = wanted
+
+
+# The HTTPConnection functions replaced while the patches are installed
+_originals = {}
+
+
+def _patched_methods():
+    return [('request', _request), ('getresponse', _getresponse),
+            ('putrequest', _putrequest), ('putheader', _putheader),
+            ('endheaders', _endheaders), ('send', _send), ('close', _close)]
+
+
+## Instrumentation
+#
+# Hot paths only check ``_instrument is not None`` and the intercept is
+# only wrapped while an instrument is set, so that instrumentation
+# costs nothing when it's off.
+
+_instrument = None
+
+
+def set_instrument(instrument):
+    """Report Dalton's counters and timings to ``instrument``, or stop
+    reporting them with None, returning the previous instrument
+
+    An instrument (such as :class:`Metrics`) has a ``count(name,
+    value=1)`` and a ``timing(name, seconds)`` method, which may be
+    called by several threads at once.
+
+    """
+    global _instrument
+    with _injection_lock:
+        previous = _instrument
+        _instrument = instrument
+        if _injection['installed']:
+            httplib.HTTPConnection._intercept = _intercept_method()
+    return previous
+
+
+def _intercept_method():
+    return _intercept if _instrument is None else _timed_intercept
+
+
+def _measure(name, func, *args):
+    """Call func, reporting how long it took as the ``name`` timing"""
+    instrument = _instrument
+    start = time.time()
+    try:
+        return func(*args)
+    finally:
+        if instrument is not None:
+            instrument.timing(name, time.time() - start)
+
 
+class Metrics(object):
+    """An instrument that keeps counters and timings in memory
 
-class RegisteredInjections(threading.local):
+    ``counters`` maps each name to its total, ``timings`` maps each name
+    to a dict of the ``count``, ``total`` and ``max`` seconds. Cache
+    lookups are counted as ``cache.<name>.hit`` and ``cache.<name>.miss``.
+
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.timings = {}
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def timing(self, name, seconds):
+        with self._lock:
+            timing = self.timings.get(name)
+            if timing is None:
+                timing = self.timings[name] = {'count': 0, 'total': 0.0,
+                                               'max': 0.0}
+            timing['count'] += 1
+            timing['total'] += seconds
+            timing['max'] = max(timing['max'], seconds)
+
+    def hit_rate(self, cache):
+        """The fraction of lookups in the named cache that were hits, or
+        None if there were none"""
+        with self._lock:
+            hits = self.counters.get('cache.%s.hit' % cache, 0)
+            lookups = hits + self.counters.get('cache.%s.miss' % cache, 0)
+        return hits / float(lookups) if lookups else None
+
+    def snapshot(self):
+        """Return a copy of the counters and timings, with the mean of
+        every timing"""
+        with self._lock:
+            timings = {}
+            for name, timing in self.timings.items():
+                timings[name] = dict(timing,
+                                     mean=timing['total'] / timing['count'])
+            return {'counters': dict(self.counters), 'timings': timings}
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.timings.clear()
+
+
+class RegisteredInjections(object):
     """Setup as a module-global to track injections that are
-    registered"""
+    registered
+
+    ``callers`` is keyed weakly by HTTPConnection instances and classes
+    so that resolving an intercept is a dictionary lookup on the
+    connection making the call. ``scopes`` is the stack of global
+    recorders/players, the innermost of which applies to every
+    connection. ``stack_callers`` holds callers that opted in to the
+    frame-walking fallback.
+
+    Registrations are shared by every thread. Changes are made under a
+    lock, while lookups don't lock: ``scopes`` is replaced rather than
+    modified so it can be read at any time.
+
+    """
     def __init__(self):
-        threading.local.__init__(self)
-        self.callers = {}
-        self._global = False
+        self.callers = weakref.WeakKeyDictionary()
+        self.stack_callers = {}
+        self.scopes = []
+        self._lock = threading.Lock()
+
+    def register(self, owner, intercept):
+        """Register the intercept for a Recorder or Player"""
+        with self._lock:
+            if owner._registered:
+                return
+            owner._registered = True
+            _acquire_patches()
+            if owner._global:
+                self.scopes = self.scopes + [intercept]
+            elif owner._walk_stack:
+                self.stack_callers[owner._caller] = intercept
+            else:
+                self.callers[owner._caller] = intercept
+
+    def unregister(self, owner, intercept):
+        """Remove an intercept previously added with register"""
+        with self._lock:
+            if not owner._registered:
+                return
+            owner._registered = False
+            _release_patches()
+            if owner._global:
+                scopes = list(self.scopes)
+                for index in range(len(scopes) - 1, -1, -1):
+                    if scopes[index] is intercept:
+                        del scopes[index]
+                        break
+                self.scopes = scopes
+                return
+            if owner._walk_stack:
+                callers = self.stack_callers
+            else:
+                callers = self.callers
+            if callers.get(owner._caller) is intercept:
+                del callers[owner._caller]
 
 _registered_injections = RegisteredInjections()
 
 
+def _check_caller(caller, walk_stack):
+    """Ensure the caller can be resolved without walking the stack"""
+    if walk_stack:
+        return
+    if isinstance(caller, httplib.HTTPConnection):
+        return
+    if inspect.isclass(caller) and issubclass(caller, httplib.HTTPConnection):
+        return
+    raise Exception("Caller %r is not an HTTPConnection instance or class, "
+                    "use walk_stack=True to find it by inspecting the "
+                    "call-stack." % (caller,))
+
+
 class FileWrapper(object):
-    """A file-wrapper for easy load/save of body content"""
-    def __init__(self, filename, directory):
+    """A file-wrapper for easy load/save of body content
+
+    The content is compressed on disk when a ``compression`` (one of
+    ``compression_suffixes``) is given, and transparently decompressed
+    when read.
+
+    """
+    def __init__(self, filename, directory, compression=None):
+        if compression and compression not in compression_suffixes:
+            raise Exception("Unknown compression %r." % (compression,))
         self.filename = filename
         self.directory = directory
+        self.compression = compression
     
+    @property
+    def path(self):
+        return os.path.abspath(os.path.join(self.directory, self.filename))
+
     def write(self, content):
+        """Write the content, which may be a string or a file-like
+        object that is copied from its current position"""
         file_loc = os.path.join(self.directory, self.filename)
-        with open(file_loc, 'w') as f:
-            f.write(content)
+        with open(file_loc, 'wb') as f:
+            if self.compression:
+                compressor = _compressor(self.compression)
+                for chunk in _read_chunks(content):
+                    f.write(compressor.compress(chunk))
+                f.write(compressor.flush())
+            elif hasattr(content, 'read'):
+                shutil.copyfileobj(content, f)
+            else:
+                f.write(content)
     
     def load(self):
+        if _instrument is not None:
+            return _measure('body_load', self._load)
+        return self._load()
+
+    def _load(self):
+        if self.compression:
+            body = self.open()
+            try:
+                return body.read()
+            finally:
+                body.close()
         file_loc = os.path.join(self.directory, self.filename)
         with open(file_loc, 'r') as f:
             content = f.read()
         return content
+
+    def open(self):
+        """Return a lazy reader for the content, memory-mapped or
+        decompressing as it's read"""
+        file_loc = os.path.join(self.directory, self.filename)
+        if self.compression:
+            return DecompressingBody(file_loc, self.compression)
+        return MappedBody(file_loc)
     
     def __repr__(self):
+        if self.compression:
+            return "FileWrapper('%s', here, '%s')" % (self.filename,
+                                                      self.compression)
         return "FileWrapper('%s', here)" % self.filename
     __str__ = __repr__
 
 
+compression_suffixes = {'zlib': '.zlib', 'gzip': '.gz', 'bz2': '.bz2'}
+
+
+def _compressor(compression):
+    if compression == 'zlib':
+        return zlib.compressobj()
+    elif compression == 'gzip':
+        return zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED,
+                                16 + zlib.MAX_WBITS)
+    return bz2.BZ2Compressor()
+
+
+def _decompressor(compression):
+    if compression == 'zlib':
+        return zlib.decompressobj()
+    elif compression == 'gzip':
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    return bz2.BZ2Decompressor()
+
+
+def _read_chunks(content, chunk_size=65536):
+    """Iterate over a string, or a file-like object from its current
+    position, in chunks"""
+    if not hasattr(content, 'read'):
+        yield content
+        return
+    chunk = content.read(chunk_size)
+    while chunk:
+        yield chunk
+        chunk = content.read(chunk_size)
+
+
+class DecompressingBody(object):
+    """A read-only file-like view of a compressed body file
+
+    The file is opened on the first read and only decompressed as far
+    as has been read. For ``zlib`` and ``gzip`` bodies ``read(amt)``
+    never holds much more than ``amt`` bytes of decompressed content.
+    ``bz2`` can't bound its output, and yields whole compressed blocks
+    (of up to 900 KB of content, or more for long runs of a byte), so
+    it is fed ``bz2_chunk_size`` bytes at a time to stop as soon as
+    the first block comes out.
+
+    """
+    chunk_size = 65536
+    bz2_chunk_size = 4096
+
+    def __init__(self, path, compression):
+        self.path = path
+        self.compression = compression
+        self._file = None
+        self._decompressor = None
+        self._buffer = ''
+        self._pending = ''
+        self._eof = False
+        self._closed = False
+
+    def _fill(self, amt):
+        """Decompress until ``amt`` bytes are buffered (or the end)"""
+        if self._file is None:
+            self._file = open(self.path, 'rb')
+            self._decompressor = _decompressor(self.compression)
+        bounded = self.compression != 'bz2'
+        while not self._eof and (amt is None or len(self._buffer) < amt):
+            if not self._pending:
+                self._pending = self._file.read(
+                    self.chunk_size if bounded else self.bz2_chunk_size)
+                if not self._pending:
+                    self._eof = True
+                    if bounded:
+                        self._buffer += self._decompressor.flush()
+                    break
+            if bounded:
+                want = self.chunk_size if amt is None else \
+                    max(amt - len(self._buffer), 1)
+                self._buffer += self._decompressor.decompress(self._pending,
+                                                              want)
+                self._pending = self._decompressor.unconsumed_tail
+            else:
+                try:
+                    self._buffer += self._decompressor.decompress(
+                        self._pending)
+                except EOFError:
+                    self._eof = True
+                self._pending = ''
+
+    def read(self, amt=None):
+        if self._closed:
+            return ''
+        if amt is not None and amt < 0:
+            amt = None
+        self._fill(amt)
+        if amt is None:
+            data, self._buffer = self._buffer, ''
+        else:
+            data, self._buffer = self._buffer[:amt], self._buffer[amt:]
+        return data
+
+    def readbuffer(self, amt=None):
+        return buffer(self.read(amt))
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+        self._buffer = self._pending = ''
+        self._closed = True
+
+
+class BlobWrapper(FileWrapper):
+    """A body kept in a :class:`BlobStore`, named by its digest"""
+    def __init__(self, digest, store_dir):
+        FileWrapper.__init__(self, digest[2:],
+                             os.path.join(store_dir, digest[:2]))
+        self.digest = digest
+        self.store_dir = store_dir
+
+    def write(self, content):
+        raise Exception("Blobs can't be rewritten.")
+
+    def __repr__(self):
+        return "dalton.BlobWrapper('%s', %r)" % (self.digest, self.store_dir)
+    __str__ = __repr__
+
+
+class BlobStore(object):
+    """A content-addressed store of bodies that recordings share
+
+    Each body is stored once, under its SHA-1 digest, no matter how
+    many steps and recordings contain it. Every reference added is
+    counted in a ``.refs`` file next to the blob. References are
+    dropped with :meth:`release` (or :meth:`release_recording` when
+    deleting a recording), and :meth:`collect` removes the blobs that
+    are no longer referenced.
+
+    """
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+        self._lock = threading.Lock()
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+    def wrapper(self, digest):
+        return BlobWrapper(digest, self.directory)
+
+    def add(self, body):
+        """Store a body (a string, file-like object or FileWrapper) and
+        add a reference to it, returning its BlobWrapper"""
+        digest = hashlib.sha1()
+        fd, temp_path = tempfile.mkstemp(dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in _iter_body(body):
+                    digest.update(chunk)
+                    f.write(chunk)
+            wrapper = self.wrapper(digest.hexdigest())
+            if not os.path.exists(wrapper.directory):
+                try:
+                    os.mkdir(wrapper.directory)
+                except OSError:
+                    # Made by someone else in the meantime
+                    pass
+            if os.path.exists(wrapper.path):
+                os.remove(temp_path)
+            else:
+                os.rename(temp_path, wrapper.path)
+        except:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        self._update_refs(wrapper, 1)
+        return wrapper
+
+    def release(self, digest):
+        """Drop a reference to a blob"""
+        self._update_refs(self.wrapper(digest), -1)
+
+    def release_recording(self, playback_dir):
+        """Drop the references held by every step of a recording"""
+        for digest in self.recording_refs(playback_dir):
+            self.release(digest)
+
+    def recording_refs(self, playback_dir):
+        """Return the digests of the blobs a recording refers to, once
+        per reference"""
+        digests = []
+        for step in iter_steps(load_recording(playback_dir)):
+            for body in (step.recorded_request['body'],
+                         step.recorded_response['body']):
+                if isinstance(body, BlobWrapper):
+                    digests.append(body.digest)
+        return digests
+
+    def refs(self, digest):
+        """Return the number of references to a blob"""
+        try:
+            with open(self.wrapper(digest).path + '.refs') as f:
+                return int(f.read() or 0)
+        except IOError:
+            return 0
+
+    def _update_refs(self, wrapper, change):
+        with self._lock:
+            with open(wrapper.path + '.refs', 'a+') as f:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_EX)
+                f.seek(0)
+                count = int(f.read() or 0) + change
+                f.seek(0)
+                f.truncate()
+                f.write(str(max(count, 0)))
+
+    def collect(self):
+        """Remove the blobs without references, returning the number
+        of blobs and bytes removed"""
+        removed = freed = 0
+        for prefix in os.listdir(self.directory):
+            prefix_dir = os.path.join(self.directory, prefix)
+            if len(prefix) != 2 or not os.path.isdir(prefix_dir):
+                continue
+            for name in os.listdir(prefix_dir):
+                if name.endswith('.refs'):
+                    continue
+                digest = prefix + name
+                if self.refs(digest) > 0:
+                    continue
+                path = os.path.join(prefix_dir, name)
+                freed += os.path.getsize(path)
+                os.remove(path)
+                if os.path.exists(path + '.refs'):
+                    os.remove(path + '.refs')
+                removed += 1
+        return removed, freed
+
+
+class BodyDigest(object):
+    """A request body kept only as its SHA-1 digest and length
+
+    Recorders with ``request_bodies='digest'`` record these instead of
+    the request bodies, with the first ``prefix`` bytes of the body for
+    diagnostics. :func:`body_digest` returns the digest, so a digest
+    matches the same requests the whole body would.
+
+    """
+    def __init__(self, sha1, length, prefix=''):
+        self.sha1 = sha1
+        self.length = length
+        self.prefix = prefix
+
+    @classmethod
+    def of(cls, body, prefix_length=0):
+        """Digest a string, FileWrapper, file-like (from its current
+        position) or iterable body chunk by chunk, returning None for
+        an empty body"""
+        hasher = BodyHasher(prefix_length)
+        if isinstance(body, FileWrapper):
+            chunks = _iter_body(body)
+        elif isinstance(body, basestring) or hasattr(body, 'read'):
+            chunks = _read_chunks(body)
+        else:
+            chunks = body
+        for chunk in chunks:
+            hasher.update(chunk)
+        return hasher.result()
+
+    def spec(self):
+        return {'sha1': self.sha1, 'length': self.length,
+                'prefix': self.prefix}
+
+    def __eq__(self, other):
+        return isinstance(other, BodyDigest) and \
+            (self.sha1, self.length) == (other.sha1, other.length)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.sha1)
+
+    def __repr__(self):
+        return 'dalton.BodyDigest(%r, %r, %r)' % (self.sha1, self.length,
+                                                  self.prefix)
+    __str__ = __repr__
+
+
+class BodyHasher(object):
+    """Builds a :class:`BodyDigest` from the chunks of a body as they
+    are sent"""
+    def __init__(self, prefix_length=0):
+        self._sha1 = hashlib.sha1()
+        self._prefix = []
+        self._prefix_length = prefix_length
+        self.length = 0
+
+    def update(self, data):
+        self._sha1.update(data)
+        missing = self._prefix_length - min(self.length,
+                                            self._prefix_length)
+        if missing:
+            self._prefix.append(str(data[:missing]))
+        self.length += len(data)
+
+    def result(self):
+        if not self.length:
+            return None
+        return BodyDigest(self._sha1.hexdigest(), self.length,
+                          ''.join(self._prefix))
+
+
+def _iter_body(body, chunk_size=65536):
+    """Iterate over a string, file-like or FileWrapper body in chunks"""
+    if isinstance(body, basestring):
+        yield body
+        return
+    if isinstance(body, FileWrapper):
+        source = body.open()
+        try:
+            chunk = source.readbuffer(chunk_size)
+            while chunk:
+                yield chunk
+                chunk = source.readbuffer(chunk_size)
+        finally:
+            source.close()
+        return
+    body.seek(0)
+    for chunk in _read_chunks(body, chunk_size):
+        yield chunk
+
+
+class MappedBody(object):
+    """A read-only file-like view of a body file (or a region of it)
+
+    The file is memory-mapped on the first read, and ``readbuffer``
+    and ``readinto`` hand out the content without copying it into an
+    intermediate string.
+
+    """
+    def __init__(self, path, offset=0, length=None):
+        self.path = path
+        self.offset = offset
+        self.length = length
+        self._map = None
+        self._pos = self._end = 0
+        self._closed = False
+
+    def _open(self):
+        instrument = _instrument
+        if instrument is not None:
+            start = time.time()
+        with open(self.path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if self.length is None:
+                self.length = size - self.offset
+            if self.length:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self._map = ''
+        self._pos = self.offset
+        self._end = self.offset + self.length
+        if instrument is not None:
+            instrument.timing('body_load', time.time() - start)
+
+    def _advance(self, amt):
+        """Return the start and size of the next ``amt`` bytes"""
+        if self._closed:
+            return self._pos, 0
+        if self._map is None:
+            self._open()
+        start = self._pos
+        remaining = self._end - start
+        if amt is None or amt < 0 or amt > remaining:
+            amt = remaining
+        self._pos += amt
+        return start, amt
+
+    def read(self, amt=None):
+        start, amt = self._advance(amt)
+        return self._map[start:start + amt] if amt else ''
+
+    def readbuffer(self, amt=None):
+        """Return the next ``amt`` bytes as a buffer onto the mapping"""
+        start, amt = self._advance(amt)
+        return buffer(self._map, start, amt) if amt else buffer('')
+
+    def readinto(self, b):
+        start, amt = self._advance(len(b))
+        if amt:
+            b[:amt] = buffer(self._map, start, amt)
+        return amt
+
+    def close(self):
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+        self._map = None
+        self._closed = True
+
+
 class InteractionStep(object):
     """Represents an interaction step used for recording and
     serializing interactions with an HTTP server"""
@@ -66,29 +756,54 @@ class InteractionStep(object):
         self.response_status = self.response_reason = None
         self.response_headers = {}
         self.response_body = self.response_version = None
+        self.timing = None
+        self.connection = None
     
+    @classmethod
+    def from_recorded(cls, step):
+        """Create an InteractionStep from a recorded step class"""
+        request = step.recorded_request
+        response = step.recorded_response
+        new_step = cls(host=request.get('host'))
+        new_step.request_method = request['method']
+        new_step.request_url = request['url']
+        new_step.request_body = request['body']
+        new_step.request_headers = request['headers']
+        new_step.response_status = response['status']
+        new_step.response_reason = response['reason']
+        new_step.response_version = response['version']
+        new_step.response_headers = response['headers']
+        new_step.response_body = response['body']
+        new_step.timing = getattr(step, 'recorded_timing', None)
+        new_step.connection = getattr(step, 'recorded_connection', None)
+        return new_step
+
     def _pprint(self, obj):
         out = StringIO.StringIO()
         pprint.pprint(obj, indent=21, stream=out)
         out.seek(0)
         content = out.read()
-        content = content[:1] + content[21:]
+        # Short values fit on one line without the indent
+        content = content[:1] + content[1:].lstrip(' ')
         return content.strip()
     
-    def serialize(self, step_number, next_step, output_dir):
-        """Save the request/response bodies to the output dir and
-        return the class code for this step"""
-        
-        request_body = self.request_body
-        if request_body:
-            request_body = FileWrapper('step_%s_request.txt' % step_number, output_dir)
-            request_body.write(self.request_body)
-        response_body = self.response_body
-        if response_body:
-            response_body = FileWrapper('step_%s_response.txt' % step_number, output_dir)
-            response_body.write(self.response_body)
+    def serialize(self, step_number, next_step, output_dir, blob_store=None,
+                  compression=None, compress_threshold=0):
+        """Save the request/response bodies to the output dir (or the
+        blob_store) and return the class code for this step
+
+        Bodies of at least ``compress_threshold`` bytes written to the
+        output dir are compressed with ``compression``.
+
+        """
+        request_body, response_body = self.write_bodies(
+            step_number, output_dir, blob_store, compression,
+            compress_threshold)
+        if response_body is None:
+            response_body = "''"
         data = {
             'step_number': step_number,
+            'host': self.host,
             'request_url': self.request_url,
             'request_method': self.request_method,
             'request_body': request_body,
@@ -98,47 +813,303 @@ class InteractionStep(object):
             'response_status': self.response_status,
             'response_version': self.response_version,
             'response_reason': self.response_reason,
-            'next_step': next_step
+            'next_step': next_step,
+            'timing': self.timing,
+            'connection': self.connection,
         }
         return step_template % data
 
+    def write_bodies(self, step_number, output_dir, blob_store=None,
+                     compression=None, compress_threshold=0):
+        """Write the request and response bodies, returning their
+        FileWrappers (or None for no content)"""
+        options = (output_dir, blob_store, compression, compress_threshold)
+        request_body = self._write_body(
+            self.request_body, 'step_%s_request.txt' % step_number, *options)
+        response_body = self._write_body(
+            self.response_body, 'step_%s_response.txt' % step_number,
+            *options)
+        return request_body, response_body
+
+    def _write_body(self, body, filename, output_dir, blob_store=None,
+                    compression=None, compress_threshold=0):
+        """Write a body to the output dir, returning its FileWrapper or
+        None when there's no content
+
+        The body is a string, a file-like object or a FileWrapper. A
+        FileWrapper already pointing at the file is left as it is. With
+        a blob_store, non-empty bodies are added to the store instead.
+
+        """
+        if isinstance(body, BodyDigest):
+            return body
+        if isinstance(body, FileWrapper):
+            same_file = body.path == FileWrapper(filename, output_dir).path
+            if same_file or blob_store is not None:
+                length = 1
+            else:
+                length = _body_length(body)
+        elif hasattr(body, 'read'):
+            body.seek(0, os.SEEK_END)
+            length = body.tell()
+            body.seek(0)
+        else:
+            length = len(body or '')
+        if not length:
+            return None
+        if blob_store is not None:
+            return blob_store.add(body)
+        if isinstance(body, FileWrapper) and same_file:
+            return body
+
+        if compression and length >= compress_threshold:
+            filename += compression_suffixes[compression]
+        else:
+            compression = None
+        wrapper = FileWrapper(filename, output_dir, compression)
+        if isinstance(body, FileWrapper):
+            source = body.open()
+            try:
+                wrapper.write(source)
+            finally:
+                source.close()
+        else:
+            wrapper.write(body)
+        return wrapper
+
 
 class Request(object):
     pass
 
 
+class ResponseTee(object):
+    """Replacement for an HTTPResponse's ``read`` method that copies
+    the body to a spool file as the caller reads it
+
+    The response is otherwise left alone, so chunked transfer-encoding
+    and the first byte of the body reach the caller as they would
+    without recording. With ``close=True`` the spool is closed once the
+    body has been read.
+
+    """
+    def __init__(self, response, spool, close=False, timing=None):
+        self._response = response
+        self._read = response.read
+        self.spool = spool
+        self.complete = False
+        self._close = close
+        self._timing = timing
+
+    def __call__(self, amt=None):
+        data = self._read(amt)
+        if data:
+            self.spool.write(data)
+            if _instrument is not None:
+                _instrument.count('recorded.bytes', len(data))
+        # The body has been read in full once the response is closed,
+        # even though the caller hasn't seen an empty read yet
+        if not data or amt is None or self._response.isclosed():
+            if not self.complete:
+                if self._close:
+                    self.spool.close()
+                if self._timing is not None:
+                    self._timing['total'] = round(
+                        time.time() - self._timing['started'], 6)
+            self.complete = True
+        return data
+
+    def drain(self):
+        """Copy what the caller left unread of the body to the spool
+
+        Returns False when part of the body can't be read any more, as
+        the response was closed before the caller had read it all.
+
+        """
+        if not self.complete:
+            data = self._read(65536)
+            while data:
+                self.spool.write(data)
+                if _instrument is not None:
+                    _instrument.count('recorded.bytes', len(data))
+                data = self._read(65536)
+            if self._close:
+                self.spool.close()
+            self.complete = True
+        return not getattr(self._response, 'length', None)
+
+
+class _TruncatingSpool(object):
+    """Spool for a :class:`ResponseTee` that keeps the first ``limit``
+    bytes of a body, and hands them to ``done`` once the body has been
+    read, ending with :data:`truncated_marker` if there was more"""
+    def __init__(self, limit, done):
+        self._limit = limit
+        self._done = done
+        self._chunks = []
+        self._kept = 0
+        self._length = 0
+
+    def write(self, data):
+        self._length += len(data)
+        if self._limit is not None:
+            data = data[:max(self._limit - self._kept, 0)]
+        if data:
+            self._chunks.append(data)
+            self._kept += len(data)
+
+    def close(self):
+        body = ''.join(self._chunks)
+        if self._length > self._kept:
+            body += truncated_marker % self._length
+        self._done(body)
+
+
+class _PendingRequests(object):
+    """The requests waiting for their response, by connection
+
+    Connections are held weakly, so a connection that is dropped
+    without getting its response (as when sending the request failed)
+    doesn't keep its request. A request made without a connection is
+    held under None.
+
+    """
+    def __init__(self):
+        self._connections = weakref.WeakKeyDictionary()
+        self._unbound = {}
+
+    def _requests(self, connection):
+        if connection is None:
+            return self._unbound
+        return self._connections
+
+    def __setitem__(self, connection, request):
+        self._requests(connection)[connection] = request
+
+    def __contains__(self, connection):
+        return connection in self._requests(connection)
+
+    def __len__(self):
+        return len(self._connections) + len(self._unbound)
+
+    def get(self, connection, default=None):
+        return self._requests(connection).get(connection, default)
+
+    def pop(self, connection, *default):
+        return self._requests(connection).pop(connection, *default)
+
+
+# Serializes opening the journals of per-process recorders, by pid
+_worker_locks = {}
+
+
 class Recorder(object):
     """Creates a recorder
 
-    A Recorder instance records all httplib remote calls that originate
-    under the ``caller`` provided during initialization while the
-    recorder is active (has been started).
+    A Recorder instance records all httplib remote calls made by the
+    ``caller`` provided during initialization while the recorder is
+    active (has been started). The ``caller`` is an HTTPConnection
+    instance, or an HTTPConnection class to record every connection of
+    that class.
+
+    Any other object (such as a mechanize Browser) can be used as the
+    ``caller`` by passing ``walk_stack=True``, in which case the
+    call-stack of each request is inspected for a method of the
+    ``caller``. This is considerably slower.
+
+    By default each response body is read in full when the response
+    arrives. With ``streaming=True`` the body is instead copied to a
+    spool file as the caller reads it, which is kept in memory until
+    it exceeds ``spool_threshold`` bytes and then moves to disk.
+
+    A recorder may be used by several threads at once, requests and
+    responses are paired up per connection.
+
+    With a ``journal_dir`` each step is written to that recording
+    directory as soon as its response arrives, instead of being kept
+    in memory until :meth:`save`. The generated ``__init__.py`` is only
+    ever appended to, so the recording can be played back at any time
+    (including after a crash), and :meth:`save` merely marks the end
+    of the recording. When streaming, the body is written straight to
+    its file in the journal as the caller reads it.
+
+    With ``per_process=True`` as well, every process using the recorder
+    (such as the workers of a :mod:`multiprocessing` pool forked after
+    it was started) journals its steps to a ``worker_<pid>`` directory
+    of its own under the ``journal_dir``, and the steps are tagged with
+    the worker. :meth:`save` then merges the journals into one
+    recording in the ``journal_dir`` (see :func:`merge_journals`).
+
+    Bodies are saved to a shared :class:`BlobStore` instead of the
+    recording directory when a ``blob_store`` is given. Otherwise bodies
+    of at least ``compress_threshold`` bytes are compressed when saved
+    if a ``compression`` (``'zlib'``, ``'gzip'`` or ``'bz2'``) is given.
+
+    With ``request_bodies='digest'`` request bodies aren't kept, only a
+    :class:`BodyDigest` (with the first ``digest_prefix`` bytes) that is
+    computed as the body is sent.
+
+    Every step records the connection it was sent on (numbered in the
+    order connections were first used), whether its socket was already
+    open and whether the response closed it, so that playback can tell
+    whether connections are reused as they were when recording.
 
     """
-    def __init__(self, caller=None, use_global=False):
+    def __init__(self, caller=None, use_global=False, walk_stack=False,
+                 streaming=False, spool_threshold=1024 * 1024,
+                 journal_dir=None, blob_store=None, compression=None,
+                 compress_threshold=1024, request_bodies='full',
+                 digest_prefix=0, per_process=False):
         """Create a record for the given caller"""
+        if not use_global:
+            _check_caller(caller, walk_stack)
         self._caller = caller
         self._global = use_global
+        self._walk_stack = walk_stack
+        self._streaming = streaming
+        self._spool_threshold = spool_threshold
         self._interaction = []
-        self._current_step = None
+        self._pending = _PendingRequests()
+        self._lock = threading.Lock()
+        self._connection_ids = weakref.WeakKeyDictionary()
+        self._connections = 0
+        self._tees = []
+        if streaming and journal_dir and blob_store is not None:
+            raise Exception("Streamed journal bodies can't be saved to a "
+                            "blob store.")
+        if compression and compression not in compression_suffixes:
+            raise Exception("Unknown compression %r." % (compression,))
+        if request_bodies not in ('full', 'digest'):
+            raise Exception("Unknown request_bodies %r." % (request_bodies,))
+        if per_process and not journal_dir:
+            raise Exception("Recording per process requires a journal_dir.")
+        self._digest_bodies = request_bodies == 'digest'
+        self._digest_prefix = digest_prefix
+        self._blob_store = blob_store
+        self._compression = compression
+        self._compress_threshold = compress_threshold
+        self._journal_dir = journal_dir
+        self._journal_steps = 0
+        self._per_process = per_process
+        self._worker = None
+        self._pid = os.getpid()
+        if per_process:
+            # Each process opens its own journal on its first request
+            self._journal_root = journal_dir
+            self._journal_dir = None
+            if not os.path.isdir(journal_dir):
+                os.makedirs(journal_dir)
+        elif journal_dir:
+            self._open_journal()
+        self._registration = {'mode': 'normal', 'recorder': self}
+        self._registered = False
 
     def start(self):
         """Called to begin/resume a recording of an interaction"""
-        callers = _registered_injections.callers
-        if self._global:
-            callers['_global'] = {'mode': 'normal', 'recorder': self}
-        else:
-            callers[self._caller] = {'mode': 'normal', 'recorder': self}
-        self._orig_global = _registered_injections._global
-        _registered_injections._global = self._global
+        _registered_injections.register(self, self._registration)
 
     def stop(self):
         """Called to stop recording an interaction"""
-        if self._global and '_global' in _registered_injections.callers:
-            del _registered_injections.callers['_global']
-        elif self._caller in _registered_injections.callers:
-            del _registered_injections.callers[self._caller]
-        _registered_injections._global = self._orig_global
+        _registered_injections.unregister(self, self._registration)
 
     @contextmanager
     def recording(self):
@@ -149,90 +1120,476 @@ class Recorder(object):
         finally:
             self.stop()
 
-    def _record_request(self, host, method, url, body, headers):
+    def _record_request(self, host, method, url, body, headers,
+                        connection=None):
+        if self._per_process and (self._worker is None or
+                                  self._pid != os.getpid()):
+            self._open_worker()
         new_step = InteractionStep(host=host)
         new_step.request_method = method
         new_step.request_url = url
+        if self._digest_bodies and body is not None:
+            body = BodyDigest.of(body, self._digest_prefix)
         new_step.request_body = body
         new_step.request_headers = headers
-        self._current_step = new_step
+        new_step.timing = {'started': time.time()}
+        if connection is not None:
+            new_step.connection = self._connection(connection)
+        self._pending[connection] = new_step
+
+    def _connection(self, connection):
+        """Describe the connection a request is sent on: its number in
+        the recording and whether its socket is already open"""
+        with self._lock:
+            number = self._connection_ids.get(connection)
+            if number is None:
+                number = self._connection_ids[connection] = self._connections
+                self._connections += 1
+        info = {'id': number,
+                'reused': getattr(connection, 'sock', None) is not None}
+        if self._worker:
+            info['worker'] = self._worker
+        return info
 
-    def _record_response(self, http_response):
-        new_step = self._current_step
+    def _open_worker(self):
+        """Start journaling the steps of this process to a worker
+        directory of its own
+
+        A forked process inherits the state of its parent's recorder,
+        including locks that may have been held while forking and the
+        requests in flight, so these start afresh. The threads of a
+        process making their first requests at once open the journal
+        once.
+
+        """
+        pid = os.getpid()
+        # A lock of this process's own, as one held by another thread
+        # while forking would never be released in the child
+        with _worker_locks.setdefault(pid, threading.Lock()):
+            if self._pid != pid:
+                self._worker = None
+                self._lock = threading.Lock()
+                self._pending = _PendingRequests()
+                self._connection_ids = weakref.WeakKeyDictionary()
+                self._connections = 0
+                self._pid = pid
+            if self._worker is None:
+                worker = 'worker_%s' % pid
+                self._journal_dir = os.path.join(self._journal_root, worker)
+                self._journal_steps = 0
+                self._open_journal()
+                self._worker = worker
+
+    def _record_response(self, http_response, connection=None):
+        new_step = self._pending.pop(connection, None)
         if not new_step:
             raise Exception("Called record response when no request was made.")
 
-        new_step.response_status = http_response.status
-        new_step.response_reason = http_response.reason
-        new_step.response_version = http_response.version
-        new_step.response_headers = http_response.getheaders()
+        self._capture_response(new_step, http_response)
+        timing = new_step.timing
+        if self._streaming and self._journal_dir:
+            with self._lock:
+                step_number = self._journal_steps
+                self._journal_steps += 1
+            body = FileWrapper('step_%s_response.txt' % step_number,
+                               self._journal_dir)
+            http_response.read = self._tee(new_step, ResponseTee(
+                http_response, open(body.path, 'wb'), close=True))
+            new_step.response_body = body
+            self._journal(new_step, step_number)
+            return
+        elif self._streaming:
+            spool = tempfile.SpooledTemporaryFile(
+                max_size=self._spool_threshold)
+            http_response.read = self._tee(new_step, ResponseTee(
+                http_response, spool, timing=timing))
+            new_step.response_body = spool
+        else:
+            new_step.response_body = self._buffer_response(http_response)
+            timing['total'] = round(time.time() - timing['started'], 6)
+        if self._journal_dir:
+            with self._lock:
+                step_number = self._journal_steps
+                self._journal_steps += 1
+            self._journal(new_step, step_number)
+            return
+        with self._lock:
+            self._interaction.append(new_step)
+
+    def _tee(self, step, tee):
+        """Keep track of a streamed body until it has been read"""
+        with self._lock:
+            self._tees = [(other, other_tee) for other, other_tee in
+                          self._tees if not other_tee.complete]
+            self._tees.append((step, tee))
+        return tee
+
+    def _drain(self):
+        """Record the rest of the streamed bodies the caller didn't
+        read in full, so that the saved bodies are complete"""
+        with self._lock:
+            tees, self._tees = self._tees, []
+        for step, tee in tees:
+            if not tee.drain():
+                log.warning("The response body of %s %s was closed before "
+                            "being read in full, only part of it is "
+                            "recorded.", step.request_method,
+                            step.request_url)
+
+    def _discard_request(self, connection=None):
+        """Forget the pending step of a request that failed to be sent"""
+        self._pending.pop(connection, None)
+
+    def _record_body(self, data, connection=None):
+        """Add a chunk of a streamed request body to the pending step,
+        which spools it like a streamed response body"""
+        step = self._pending.get(connection)
+        if step is None:
+            return
+        if step.request_body is None:
+            if self._digest_bodies:
+                step.request_body = BodyHasher(self._digest_prefix)
+            else:
+                step.request_body = tempfile.SpooledTemporaryFile(
+                    max_size=self._spool_threshold)
+        if self._digest_bodies:
+            step.request_body.update(data)
+        else:
+            step.request_body.write(data)
+
+    def _capture_response(self, step, http_response):
+        """Fill in what is known of a step once its response arrives:
+        the time to first byte, whether the response closes the
+        connection, and the status and headers"""
+        self._finish_request(step)
+        timing = step.timing
+        timing['ttfb'] = round(time.time() - timing['started'], 6)
+        if step.connection is not None:
+            step.connection['close'] = bool(
+                getattr(http_response, 'will_close', False))
+        step.response_status = http_response.status
+        step.response_reason = http_response.reason
+        step.response_version = http_response.version
+        step.response_headers = http_response.getheaders()
+
+    def _finish_request(self, step):
+        """Turn the digest of a streamed request body into its result"""
+        if isinstance(step.request_body, BodyHasher):
+            step.request_body = step.request_body.result()
+
+    def _buffer_response(self, http_response):
+        """Read the whole body, leaving the response readable again"""
         body = http_response.read()
-        new_step.response_body = body
+        if _instrument is not None:
+            _instrument.count('recorded.bytes', len(body))
         http_response.fp = StringIO.StringIO(body)
         http_response.length = len(body)
-        self._interaction.append(new_step)
-        self._current_step = None
 
-    def save(self, output_dir):
-        """Save the recorded http interaction session to the output
-        directory"""
-        if os.path.exists(output_dir) and not os.path.isdir(output_dir):
+        # Ensure chunked is not set, since the StringIO replacement
+        # goofs it up
+        http_response.chunked = 0
+        return body
+
+    def _steps(self):
+        """The recorded steps to save"""
+        return self._interaction
+
+    def _open_journal(self):
+        """Create the journal's recording directory, or find where to
+        resume numbering the steps of an existing one"""
+        journal_dir = self._journal_dir
+        if os.path.exists(journal_dir) and not os.path.isdir(journal_dir):
             raise Exception("Name already exists, and is not a directory.")
+        if not os.path.exists(journal_dir):
+            os.mkdir(journal_dir)
+        init = os.path.join(journal_dir, '__init__.py')
+        if os.path.exists(init):
+            with open(init) as f:
+                self._journal_steps = sum(
+                    1 for line in f if line.startswith('class StepNumber'))
+        else:
+            with open(init, 'w') as f:
+                f.write('\n'.join(module_header))
 
-        if not os.path.exists(output_dir):
-            os.mkdir(output_dir)
-
-        module_str = [
-            'import os', 'import dalton', 'from dalton import FileWrapper', '',
-            'here = os.path.abspath(os.path.dirname(__file__))', ''
-        ]
-        step_len = len(self._interaction)
-        for step_number, step in enumerate(self._interaction):
-            if step_number + 1 < step_len:
-                next_step = 'StepNumber%s' % (step_number + 1)
-            else:
-                next_step = None
-            module_str.append(step.serialize(step_number, next_step, output_dir))
-            module_str.append('')
+    def _journal(self, step, step_number):
+        """Append a completed step to the journal"""
+        code = step.serialize(step_number, 'StepNumber%s' % (step_number + 1),
+                              self._journal_dir, *self._save_options())
+        with self._lock:
+            with open(os.path.join(self._journal_dir, '__init__.py'),
+                      'a') as f:
+                f.write(code + '\n')
+
+    def _save_options(self):
+        return (self._blob_store, self._compression, self._compress_threshold)
+
+    def save(self, output_dir=None, compact=False):
+        """Save the recorded http interaction session to the output
+        directory
+
+        With ``compact=True`` the steps are saved to a
+        :class:`StepTable` that is decoded as playback proceeds, rather
+        than as generated classes, which is much faster to load for
+        long recordings.
+
+        When journaling, the steps have already been saved to the
+        journal directory and this only marks the end of the recording.
+        When journaling per process, the journals of every process are
+        merged into a recording in the journal directory.
 
-        init = os.path.join(output_dir, '__init__.py')
-        with open(init, 'w') as f:
-            f.write('\n'.join(module_str))
+        """
+        self._drain()
+        if self._per_process:
+            return merge_journals(self._journal_root, output_dir, compact,
+                                  *self._save_options())
+        if self._journal_dir:
+            if compact:
+                raise Exception("A journaled recording can't be saved "
+                                "compact.")
+            if output_dir and (os.path.abspath(output_dir) !=
+                               os.path.abspath(self._journal_dir)):
+                raise Exception("A journaled recording can only be saved "
+                                "to its journal directory.")
+            with self._lock:
+                with open(os.path.join(self._journal_dir, '__init__.py'),
+                          'a') as f:
+                    f.write('StepNumber%s = None\n' % self._journal_steps)
+            return True
+
+        if _instrument is not None:
+            return _measure('save', save_recording, self._steps(),
+                            output_dir, compact, *self._save_options())
+        return save_recording(self._steps(), output_dir, compact,
+                              *self._save_options())
+
+    def save_archive(self, path):
+        """Save the recorded http interaction session to a single
+        :class:`RecordingArchive` file"""
+        self._drain()
+        RecordingArchive(path).write(self._steps())
         return True
 
 
+class RingRecorder(Recorder):
+    """A recorder that only keeps the most recent interactions
+
+    Meant to be left running (in production, say) so the interactions
+    leading up to an incident can be dumped and played back. At most
+    ``max_steps`` steps and ``max_bytes`` bytes of bodies are kept, the
+    oldest steps being dropped first. Bodies longer than
+    ``max_body_size`` are truncated, ending with :data:`truncated_marker`.
+
+    Only a ``sample_rate`` fraction of the requests are recorded, and
+    when a ``predicate`` is given only the steps it returns True for.
+    The predicate is called with the :class:`InteractionStep` once the
+    response status and headers are known, before the body is read, so
+    it can look at ``host``, ``request_method``, ``request_url`` and
+    ``response_status``.
+
+    Response bodies are copied as the caller reads them, the response
+    being otherwise left alone, and a step is added to the buffer once
+    its body has been read. The buffer is written out as a recording
+    with :meth:`dump`, or on a signal set up with
+    :meth:`dump_on_signal`. ``streaming`` and ``journal_dir`` aren't
+    supported.
+
+    """
+    def __init__(self, caller=None, use_global=False, walk_stack=False,
+                 max_steps=1000, max_bytes=None, max_body_size=64 * 1024,
+                 sample_rate=1.0, predicate=None, **kwargs):
+        if kwargs.get('streaming') or kwargs.get('journal_dir'):
+            raise Exception("A ring recorder can't stream or journal.")
+        Recorder.__init__(self, caller, use_global, walk_stack, **kwargs)
+        self._interaction = deque()
+        self._bytes = 0
+        self._max_steps = max_steps
+        self._max_bytes = max_bytes
+        self._max_body_size = max_body_size
+        self._sample_rate = sample_rate
+        self._predicate = predicate
+        self._dumps = 0
+        self.dump_thread = None
+
+    def _truncate(self, body):
+        limit = self._max_body_size
+        if limit is not None and isinstance(body, basestring) and \
+                len(body) > limit:
+            return body[:limit] + truncated_marker % len(body)
+        return body
+
+    def _record_request(self, host, method, url, body, headers,
+                        connection=None):
+        if self._sample_rate < 1.0 and random.random() >= self._sample_rate:
+            self._pending[connection] = None
+            return
+        Recorder._record_request(self, host, method, url,
+                                 self._truncate(body), headers, connection)
+
+    def _record_response(self, http_response, connection=None):
+        if connection not in self._pending:
+            raise Exception("Called record response when no request was made.")
+        new_step = self._pending.pop(connection)
+        if new_step is None:
+            return
+        self._capture_response(new_step, http_response)
+        timing = new_step.timing
+        if self._predicate and not self._predicate(new_step):
+            return
+        if http_response.length == 0:
+            timing['total'] = timing['ttfb']
+            self._add_step(new_step, '')
+            return
+        http_response.read = ResponseTee(
+            http_response, _TruncatingSpool(
+                self._max_body_size,
+                lambda body: self._add_step(new_step, body)),
+            close=True, timing=timing)
+
+    def _add_step(self, new_step, body):
+        """Add a step to the buffer once its body has been read,
+        dropping the oldest steps to make room"""
+        new_step.response_body = body
+        size = len(body)
+        if isinstance(new_step.request_body, basestring):
+            size += len(new_step.request_body)
+        new_step.size = size
+        with self._lock:
+            interaction = self._interaction
+            interaction.append(new_step)
+            self._bytes += size
+            while len(interaction) > self._max_steps or (
+                    self._max_bytes is not None and
+                    self._bytes > self._max_bytes and len(interaction) > 1):
+                self._bytes -= interaction.popleft().size
+
+    def _steps(self):
+        with self._lock:
+            return list(self._interaction)
+
+    def clear(self):
+        """Drop every step in the buffer"""
+        with self._lock:
+            self._interaction.clear()
+            self._bytes = 0
+
+    def dump(self, output_dir, compact=False):
+        """Save the steps currently in the buffer as a recording"""
+        return self.save(output_dir, compact=compact)
+
+    def dump_on_signal(self, signum, dump_dir, compact=False):
+        """Dump the buffer to a new recording under ``dump_dir`` whenever
+        the process receives ``signum``
+
+        Each dump is named after the time it was made. The dump runs in
+        a thread (available as :attr:`dump_thread`), as a signal may
+        arrive while the buffer is locked.
+
+        """
+        def handler(signum, frame):
+            self._dumps += 1
+            output_dir = os.path.join(dump_dir, 'dump_%s_%s' % (
+                time.strftime('%Y%m%d-%H%M%S'), self._dumps))
+            self.dump_thread = threading.Thread(
+                target=self.dump, args=(output_dir, compact))
+            self.dump_thread.start()
+
+        if not os.path.exists(dump_dir):
+            os.makedirs(dump_dir)
+        return signal.signal(signum, handler)
+
+
 class Player(object):
     """HTTP Interaction Player
 
-    Plays back an interaction from a dalton recording.
+    Plays back an interaction from a dalton recording, which is either
+    a directory saved by :meth:`Recorder.save` or a
+    :class:`RecordingArchive` file. The ``caller`` is resolved the same
+    way as for the :class:`Recorder`.
+
+    By default the steps are played back in the recorded order,
+    following the ``next_step`` chain. With ``match='index'`` each
+    request is instead answered by a step recorded with the same
+    :func:`request_fingerprint` (which includes the ``match_headers``),
+    regardless of order. Steps recorded with the same fingerprint are
+    played back in the recorded order. The host is left out of the
+    fingerprint with ``match_host=False``.
+
+    A :class:`Matcher` changes how requests are compared with the
+    recorded requests, in either mode. In index mode the steps are then
+    indexed by the matcher's key instead of the fingerprint.
+
+    A player may be used by several threads at once, requests and
+    responses are paired up per connection and steps are consumed
+    under a lock. With ``cursor='connection'`` every connection plays
+    the recorded chain from the start on its own, instead of all of
+    them sharing one position in the chain.
+
+    Responses are returned as fast as possible by default. With a
+    ``latency_scale`` above 0 the recorded timing of each step is
+    reproduced, scaled by that factor (1 for the recorded latency):
+    ``getresponse`` waits for the time to first byte, and reading the
+    body takes the rest of the recorded transfer time.
+
+    With ``digest_bodies=True`` request bodies are reduced to a
+    :class:`BodyDigest` as they are sent, rather than being spooled,
+    which is enough to match them (see :class:`Matcher`) against
+    recordings made with ``request_bodies='digest'``.
+
+    The player pretends to open a connection's socket on its first
+    request, keeps it open until a response that closes the connection
+    (``Connection: close``, or as recorded) or until the connection is
+    closed, and counts the connections opened in
+    :meth:`connection_stats`. The response's ``will_close`` tells the
+    client whether it closes the connection, as it would for a live
+    response.
 
     """
-    def __init__(self, playback_dir, caller=None, use_global=False):
+    def __init__(self, playback_dir, caller=None, use_global=False,
+                 walk_stack=False, match='sequence', match_headers=(),
+                 cursor='shared', match_host=True, matcher=None,
+                 latency_scale=0, digest_bodies=False):
         """Create a player from the playback_dir"""
-        mod_name = playback_dir.split(os.path.sep)[-1]
-        container_dir = playback_dir.split(os.path.sep)[:-1]
-        sys.path.insert(0, os.path.sep.join(container_dir))
+        if not use_global:
+            _check_caller(caller, walk_stack)
+        if match not in ('sequence', 'index'):
+            raise Exception("Unknown match mode %r." % (match,))
+        if cursor not in ('shared', 'connection'):
+            raise Exception("Unknown cursor %r." % (cursor,))
+        if digest_bodies and matcher is not None and matcher.json_body:
+            raise Exception("A json_body matcher can't compare digested "
+                            "request bodies.")
         self._caller = caller
         self._global = use_global
-        self._module = __import__(mod_name)
-        self._current_step = getattr(self._module, 'StepNumber0', None)
-        self._current_request = None
+        self._walk_stack = walk_stack
+        self._module = load_recording(playback_dir)
+        self._first_step = _get_step(self._module, 'StepNumber0')
+        self._current_step = self._first_step
+        self._cursors = weakref.WeakKeyDictionary() \
+            if cursor == 'connection' else None
+        self._pending = _PendingRequests()
+        self._lock = threading.Lock()
+        self._match_headers = [name.lower() for name in match_headers]
+        self._match_host = match_host
+        self._matcher = matcher
+        # Requests are matched with a matcher of the player's own by
+        # default, so its cached keys go away with the player
+        self._request_matcher = matcher or Matcher()
+        self._latency_scale = latency_scale
+        self._digest_bodies = digest_bodies
+        self._connection_stats = dict.fromkeys(
+            ['requests', 'connections', 'reused', 'recorded_connections',
+             'extra_connections'], 0)
+        self._index = None
+        if match == 'index':
+            self._build_index()
+        self._registration = {'mode': 'playback', 'playback': self}
+        self._registered = False
 
     def play(self):
-        callers = _registered_injections.callers
-        if self._global:
-            callers['_global'] = {'mode': 'playback', 'playback': self}
-        else:
-            callers[self._caller] = {'mode': 'playback', 'playback': self}
-        self._orig_global = _registered_injections._global
-        _registered_injections._global = self._global
+        _registered_injections.register(self, self._registration)
 
     def stop(self):
-        if self._global and '_global' in _registered_injections.callers:
-            del _registered_injections.callers['_global']
-        elif self._caller in _registered_injections.callers:
-            del _registered_injections.callers[self._caller]
-        _registered_injections._global = self._orig_global
+        _registered_injections.unregister(self, self._registration)
 
     @contextmanager
     def playing(self):
@@ -243,8 +1600,65 @@ class Player(object):
         finally:
             self.stop()
 
-    def request(self, method, url, body=None, headers=None):
-        if not self._current_step:
+    def _build_index(self):
+        steps = list(iter_steps(self._module))
+        self._match_host = self._match_host and all(
+            step.recorded_request.get('host') for step in steps)
+        self._index = {}
+        for step in steps:
+            recorded = step.recorded_request
+            host = recorded.get('host') if self._match_host else None
+            if self._matcher:
+                key = (host,) + self._matcher.recorded_key(recorded)
+            else:
+                key = request_fingerprint(
+                    recorded['method'], recorded['url'], recorded['body'],
+                    recorded['headers'], self._match_headers, host)
+            self._index.setdefault(key, deque()).append(step)
+
+    def _find_step(self, method, url, body, headers, host):
+        host = host if self._match_host else None
+        if self._matcher:
+            key = (host,) + self._matcher.key(method, url, body, headers)
+        else:
+            key = request_fingerprint(method, url, body, headers,
+                                      self._match_headers, host)
+        steps = self._index.get(key)
+        if not steps:
+            raise Exception("No recorded step left for %s %s." % (method, url))
+        return steps.popleft()
+
+    def _cursor(self, connection):
+        """Return the current step in the chain for the connection"""
+        if self._cursors is None:
+            return self._current_step
+        return self._cursors.get(connection, self._first_step)
+
+    def _advance(self, connection, next_step):
+        if next_step == 'None':
+            step = None
+        else:
+            step = _get_step(self._module, next_step)
+        if self._cursors is None:
+            self._current_step = step
+        else:
+            self._cursors[connection] = step
+
+    def request(self, method, url, body=None, headers=None, host=None,
+                connection=None):
+        if self._digest_bodies and body is not None and \
+                not isinstance(body, BodyDigest):
+            body = BodyDigest.of(body)
+        if self._index is not None:
+            with self._lock:
+                if _instrument is not None:
+                    step = _measure('step_lookup', self._find_step, method,
+                                    url, body, headers, host)
+                else:
+                    step = self._find_step(method, url, body, headers, host)
+        else:
+            step = self._cursor(connection)
+        if not step:
             raise Exception("Playback can't handle more requests, this is "
                             "the end of the chain.")
         req = Request()
@@ -252,67 +1666,1018 @@ class Player(object):
         req.url = url
         req.body = body
         req.headers = headers
-        self._current_request = req
-
-    def getresponse(self):
-        if not self._current_step:
-            raise Exception("Failed to find a step when a request was made.")
-        
-        if not self._current_request:
-            raise Exception("getresponse called during playback before "
-                            "a request was made.")
-
-        step = self._current_step()
-        next_step, response = step.handle_request(self._current_request)
-        if next_step == 'None':
-            self._current_step = None
-        else:
-            self._current_step = getattr(self._module, next_step)
+        req.host = host
+        req.matcher = self._request_matcher
+        if self._latency_scale:
+            req.sent = time.time()
+        if connection is not None:
+            self._connect(connection, step)
+        self._pending[connection] = (req, step)
+
+    def _connect(self, connection, step):
+        """Open the connection's (pretend) socket unless it's open"""
+        reused = self.connection_open(connection)
+        connection.__dict__['_dalton_socket'] = self
+        recorded = getattr(step, 'recorded_connection', None)
+        with self._lock:
+            stats = self._connection_stats
+            stats['requests'] += 1
+            stats['reused' if reused else 'connections'] += 1
+            if recorded is not None:
+                if not recorded['reused']:
+                    stats['recorded_connections'] += 1
+                elif not reused:
+                    stats['extra_connections'] += 1
+
+    def _disconnect(self, connection, step, response):
+        """Set whether the response closes the connection as recorded
+        (rather than from its headers), and close the connection's
+        socket if it does"""
+        recorded = getattr(step, 'recorded_connection', None)
+        if recorded is not None:
+            response.will_close = bool(recorded.get('close'))
+        if response.will_close and connection is not None:
+            connection.__dict__.pop('_dalton_socket', None)
+
+    def connection_open(self, connection):
+        """Whether the connection's socket is open (as far as the player
+        is concerned)"""
+        return connection.__dict__.get('_dalton_socket') is self
+
+    def connection_stats(self):
+        """Return how connections were used during playback
+
+        ``requests`` is the number of requests played back,
+        ``connections`` the connections they opened and ``reused`` the
+        requests sent on an open connection. ``recorded_connections`` is
+        the number of those requests that opened a connection when
+        recorded, and ``extra_connections`` the requests that opened one
+        where the recording reused a connection (a sign that the client
+        no longer keeps its connections alive).
+
+        """
+        with self._lock:
+            return dict(self._connection_stats)
+
+    def getresponse(self, connection=None):
+        if _instrument is not None:
+            return _measure('getresponse', self._respond, connection)
+        return self._respond(connection)
+
+    def _respond(self, connection):
+        req, step = self._pending.pop(connection, (None, None))
+        if self._index is not None:
+            if not req:
+                raise Exception("getresponse called during playback before "
+                                "a request was made.")
+            response = step().handle_request(req)[1]
+            self._disconnect(connection, step, response)
+            if self._latency_scale:
+                self._delay(req, step, response)
+            return response
+
+        with self._lock:
+            step = self._cursor(connection)
+            if not step:
+                raise Exception("Failed to find a step when a request was "
+                                "made.")
+            if not req:
+                raise Exception("getresponse called during playback before "
+                                "a request was made.")
+            next_step, response = step().handle_request(req)
+            if _instrument is not None:
+                _measure('step_lookup', self._advance, connection, next_step)
+            else:
+                self._advance(connection, next_step)
+        self._disconnect(connection, step, response)
+        if self._latency_scale:
+            self._delay(req, step, response)
         return response
 
+    def _delay(self, req, step, response):
+        """Wait out the step's scaled time to first byte, and throttle
+        the delivery of the body"""
+        timing = getattr(step, 'recorded_timing', None)
+        if not timing or 'ttfb' not in timing:
+            return
+        scale = self._latency_scale
+        delay = timing['ttfb'] * scale - (time.time() - req.sent)
+        if delay > 0:
+            time.sleep(delay)
+        if 'total' in timing and isinstance(response, DaltonHTTPResponse):
+            response.throttle((timing['total'] - timing['ttfb']) * scale)
+
+
+## Recording loading and archives
+
+_recording_cache = {}
+_recording_cache_lock = threading.RLock()
+
+
+def load_recording(playback_dir):
+    """Load a recording, returning the generated module or the
+    :class:`RecordingArchive` for archive files
+
+    Generated modules are imported from their path, without changing
+    ``sys.path``, under a name unique to the path. Recordings are cached
+    by path until their ``__init__.py`` (or archive file) changes, so
+    players of the same recording share its step classes.
+
+    """
+    path = os.path.abspath(playback_dir)
+    is_archive = os.path.isfile(path)
+    source = path if is_archive else os.path.join(path, '__init__.py')
+    stat = os.stat(source)
+    version = (stat.st_mtime, stat.st_size)
+    with _recording_cache_lock:
+        cached = _recording_cache.get(path)
+        if cached is not None and cached[0] == version:
+            if _instrument is not None:
+                _instrument.count('cache.recording.hit')
+            return cached[1]
+        if _instrument is not None:
+            _instrument.count('cache.recording.miss')
+        if is_archive:
+            recording = RecordingArchive(path).load()
+        else:
+            recording = _import_recording(path, source)
+        _recording_cache[path] = (version, recording)
+    return recording
+
+
+def _import_recording(path, source):
+    name = 'dalton_recording_%s' % hashlib.sha1(path).hexdigest()
+    module = imp.new_module(name)
+    module.__file__ = source
+    module.__path__ = [path]
+    with open(source, 'rU') as f:
+        code = compile(f.read(), source, 'exec')
+    sys.modules[name] = module
+    try:
+        exec code in module.__dict__
+    except:
+        del sys.modules[name]
+        raise
+    return module
+
+
+def preload_recordings(directory):
+    """Load every recording found under a directory into the
+    recording cache, returning the number loaded
+
+    Recording directories are recognized by the header of their
+    generated ``__init__.py``, archives by their magic number.
+
+    """
+    header = '\n'.join(module_header[:2])
+    count = 0
+    for dirpath, dirnames, filenames in os.walk(directory):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            with open(path, 'rb') as f:
+                start = f.read(len(header))
+            if filename == '__init__.py' and start == header:
+                load_recording(dirpath)
+            elif start.startswith(RecordingArchive.magic):
+                load_recording(path)
+            else:
+                continue
+            count += 1
+    return count
+
+
+def clear_recording_cache():
+    """Forget every loaded recording"""
+    with _recording_cache_lock:
+        _recording_cache.clear()
+
+
+def iter_steps(recording):
+    """Iterate over the step classes of a recording in chain order"""
+    step = _get_step(recording, 'StepNumber0')
+    while step:
+        yield step
+        if step.next_step == 'None':
+            break
+        step = _get_step(recording, step.next_step)
+
+
+class ArchiveBody(FileWrapper):
+    """A body stored in a region of a :class:`RecordingArchive`"""
+    def __init__(self, path, offset, length):
+        FileWrapper.__init__(self, os.path.basename(path),
+                             os.path.dirname(path))
+        self.offset = offset
+        self.length = length
+
+    def write(self, content):
+        raise Exception("Archive bodies can't be rewritten.")
+
+    def _load(self):
+        with open(os.path.join(self.directory, self.filename), 'rb') as f:
+            f.seek(self.offset)
+            return f.read(self.length)
+
+    def open(self):
+        return MappedBody(os.path.join(self.directory, self.filename),
+                          self.offset, self.length)
+
+    def __repr__(self):
+        return "ArchiveBody('%s', %s, %s)" % (self.filename, self.offset,
+                                              self.length)
+    __str__ = __repr__
+
+
+class RecordingArchive(object):
+    """A recording stored in a single file
+
+    The file starts with a fixed size header holding the offset and
+    length of the index, followed by the request and response bodies,
+    followed by the JSON index. Each index entry holds the method, URL,
+    status and headers of a step and the offset/length of its bodies,
+    so a recording is loaded by reading the index alone, without any
+    Python code being imported.
+
+    New steps are appended by writing their bodies and the extended
+    index after the end of the file, and only then pointing the header
+    at the new index, so an interrupted append leaves the archive as it
+    was (apart from the unused bytes at its end).
+
+    Once loaded the archive acts like a generated recording module,
+    with a ``StepNumberN`` class for each step.
+
+    """
+    magic = 'DALTON\x00\x01'
+    header_format = '>8sQQ'
+    header_size = struct.calcsize(header_format)
+
+    def __init__(self, path):
+        self.path = path
+        self._index = None
+
+    def write(self, steps):
+        """Write a new archive containing the InteractionSteps"""
+        with open(self.path, 'wb') as f:
+            f.write(struct.pack(self.header_format, self.magic, 0, 0))
+            self._write_steps(f, [], steps)
+        self._index = None
+
+    def append(self, steps):
+        """Append InteractionSteps to the end of the archive"""
+        if not os.path.exists(self.path):
+            return self.write(steps)
+        with open(self.path, 'r+b') as f:
+            index = self._read_index(f)[1]
+            f.seek(0, os.SEEK_END)
+            self._write_steps(f, index, steps)
+        self._index = None
+
+    def _write_steps(self, f, index, steps):
+        for step in steps:
+            index.append({
+                'host': step.host,
+                'method': step.request_method,
+                'url': step.request_url,
+                'request_headers': step.request_headers,
+                'request_body': _write_archive_body(f, step.request_body),
+                'status': step.response_status,
+                'reason': step.response_reason,
+                'version': step.response_version,
+                'response_headers': step.response_headers,
+                'response_body': _write_archive_body(f, step.response_body),
+                'timing': step.timing,
+                'connection': step.connection,
+            })
+        index_offset = f.tell()
+        data = json.dumps(index, encoding='latin-1')
+        f.write(data)
+        # The header is only updated once the bodies and index are down
+        f.flush()
+        os.fsync(f.fileno())
+        f.seek(0)
+        f.write(struct.pack(self.header_format, self.magic, index_offset,
+                            len(data)))
+
+    def _read_index(self, f):
+        magic, index_offset, index_length = struct.unpack(
+            self.header_format, f.read(self.header_size))
+        if magic != self.magic:
+            raise Exception("%s is not a dalton recording archive."
+                            % self.path)
+        f.seek(index_offset)
+        index = _latin1(json.loads(f.read(index_length)))
+        return index_offset, index
+
+    def load(self):
+        """Read the index of the archive"""
+        with open(self.path, 'rb') as f:
+            self._index = self._read_index(f)[1]
+        return self
+
+    def __len__(self):
+        if self._index is None:
+            self.load()
+        return len(self._index)
+
+    def __getattr__(self, name):
+        if not name.startswith('StepNumber'):
+            raise AttributeError(name)
+        if self._index is None:
+            self.load()
+        try:
+            step_number = int(name[len('StepNumber'):])
+            entry = self._index[step_number]
+        except (ValueError, IndexError):
+            raise AttributeError(name)
+        if step_number + 1 < len(self._index):
+            next_step = 'StepNumber%s' % (step_number + 1)
+        else:
+            next_step = 'None'
+        return _step_class(name, entry, self._body, next_step)
+
+    def _body(self, region):
+        if region is None:
+            return None
+        if isinstance(region, dict):
+            return BodyDigest(**region)
+        return ArchiveBody(self.path, region[0], region[1])
+
+
+class _DecodedDict(dict):
+    """A recorded request or response dict decoded for a single use,
+    which the caches keyed by dict skip as they'd never hit"""
+
+
+def _step_class(name, entry, body, next_step, mapping=dict):
+    """Create a RecordedStep class from an archive or step table entry,
+    using ``body`` to turn body references into FileWrappers and
+    ``mapping`` for the recorded dicts"""
+    return type(name, (RecordedStep,), {
+        'recorded_request': mapping({
+            'host': entry['host'],
+            'headers': entry['request_headers'],
+            'url': entry['url'],
+            'method': entry['method'],
+            'body': body(entry['request_body']),
+        }),
+        'recorded_response': mapping({
+            'headers': [tuple(h) for h in entry['response_headers']],
+            'body': body(entry['response_body']),
+            'status': entry['status'],
+            'reason': entry['reason'],
+            'version': entry['version'],
+        }),
+        'next_step': next_step,
+        'recorded_timing': entry.get('timing'),
+        'recorded_connection': entry.get('connection'),
+    })
+
+
+class StepTable(object):
+    """The steps of a compact recording, decoded on demand
+
+    A compact recording (see :meth:`Recorder.save`) keeps its steps as
+    JSON lines in ``steps.jsonl`` rather than as generated classes. Only
+    the offset of each line is read up front; a step is decoded when
+    playback reaches it, and isn't kept once playback moves on.
+
+    Steps are customized in the recording's ``__init__.py`` by
+    subclassing the recorded step::
+
+        class StepNumber3(steps.step(3)):
+            def handle_request(self, request):
+                ...
+
+    """
+    def __init__(self, path):
+        self.path = path
+        self.directory = os.path.dirname(path)
+        self._offsets = None
+
+    def _load_offsets(self):
+        offsets = []
+        with open(self.path, 'rb') as f:
+            offset = 0
+            for line in f:
+                if line.strip():
+                    offsets.append(offset)
+                offset += len(line)
+        self._offsets = offsets
+
+    def __len__(self):
+        if self._offsets is None:
+            self._load_offsets()
+        return len(self._offsets)
+
+    def step(self, step_number):
+        """Decode the recorded step class for a step number"""
+        if self._offsets is None:
+            self._load_offsets()
+        with open(self.path, 'rb') as f:
+            f.seek(self._offsets[step_number])
+            entry = _latin1(json.loads(f.readline()))
+        return _step_class('StepNumber%s' % step_number, entry, self._body,
+                           entry['next_step'], _DecodedDict)
+
+    def find(self, name):
+        """Return the step class for a ``StepNumberN`` name, or None"""
+        try:
+            return self.step(int(name[len('StepNumber'):]))
+        except (ValueError, IndexError):
+            return None
+
+    def _body(self, spec):
+        if spec is None:
+            return None
+        if 'blob' in spec:
+            return BlobWrapper(spec['blob'], spec['store'])
+        if 'sha1' in spec:
+            return BodyDigest(**spec)
+        return FileWrapper(spec['file'], self.directory,
+                           spec.get('compression'))
+
+    @staticmethod
+    def entry(step, bodies, next_step):
+        """Return the JSON line for an InteractionStep whose bodies have
+        been written to the ``bodies`` (request, response) wrappers"""
+        specs = []
+        for body in bodies:
+            if isinstance(body, BlobWrapper):
+                specs.append({'blob': body.digest, 'store': body.store_dir})
+            elif isinstance(body, BodyDigest):
+                specs.append(body.spec())
+            elif body is not None:
+                specs.append({'file': body.filename,
+                              'compression': body.compression})
+            else:
+                specs.append(None)
+        return json.dumps({
+            'host': step.host,
+            'method': step.request_method,
+            'url': step.request_url,
+            'request_headers': step.request_headers,
+            'request_body': specs[0],
+            'status': step.response_status,
+            'reason': step.response_reason,
+            'version': step.response_version,
+            'response_headers': step.response_headers,
+            'response_body': specs[1],
+            'next_step': str(next_step),
+            'timing': step.timing,
+            'connection': step.connection,
+        }, encoding='latin-1')
+
+
+def _get_step(recording, name):
+    """Return the step class of a recording by name, or None
+
+    Steps defined in the recording take precedence over those decoded
+    from its :class:`StepTable`.
+
+    """
+    step = getattr(recording, name, None)
+    if step is None:
+        table = getattr(recording, 'steps', None)
+        if isinstance(table, StepTable):
+            step = table.find(name)
+    return step
+
+
+def _body_length(body):
+    """Return the length of the content of a FileWrapper"""
+    if isinstance(body, ArchiveBody):
+        return body.length
+    if body.compression:
+        source = body.open()
+        length = 0
+        try:
+            chunk = source.read(65536)
+            while chunk:
+                length += len(chunk)
+                chunk = source.read(65536)
+        finally:
+            source.close()
+        return length
+    return os.path.getsize(body.path)
+
+
+def _write_archive_body(f, body):
+    """Write a body to the archive, returning its (offset, length)"""
+    if body is None:
+        return None
+    if isinstance(body, BodyDigest):
+        return body.spec()
+    offset = f.tell()
+    for chunk in _iter_body(body):
+        f.write(chunk)
+    return [offset, f.tell() - offset]
+
+
+def _latin1(obj):
+    """Turn the unicode strings from a JSON decode back into str"""
+    if isinstance(obj, unicode):
+        return obj.encode('latin-1')
+    elif isinstance(obj, list):
+        return [_latin1(item) for item in obj]
+    elif isinstance(obj, dict):
+        return dict((_latin1(k), _latin1(v)) for k, v in obj.iteritems())
+    return obj
+
+
+def save_recording(steps, output_dir, compact=False, blob_store=None,
+                   compression=None, compress_threshold=0):
+    """Save a list of :class:`InteractionStep` as a recording directory
+
+    The options are those of :meth:`Recorder.save` and the
+    :class:`Recorder`.
+
+    """
+    if os.path.exists(output_dir) and not os.path.isdir(output_dir):
+        raise Exception("Name already exists, and is not a directory.")
+
+    if not os.path.exists(output_dir):
+        os.mkdir(output_dir)
+
+    replaced = []
+    if blob_store is not None and \
+            os.path.exists(os.path.join(output_dir, '__init__.py')):
+        # The references of the recording being saved over are dropped
+        # once the new one (which may share its blobs) is saved
+        try:
+            replaced = blob_store.recording_refs(output_dir)
+        except Exception, e:
+            log.warning("Can't release the blobs of the recording saved "
+                        "over in %s: %s", output_dir, e)
+
+    _write_recording(steps, output_dir, compact,
+                     (blob_store, compression, compress_threshold))
+    for digest in replaced:
+        blob_store.release(digest)
+    return True
+
+
+def _write_recording(steps, output_dir, compact, options):
+    """Write the steps and their bodies to the recording directory"""
+    step_len = len(steps)
+    if compact:
+        with open(os.path.join(output_dir, 'steps.jsonl'), 'w') as f:
+            for step_number, step in enumerate(steps):
+                if step_number + 1 < step_len:
+                    next_step = 'StepNumber%s' % (step_number + 1)
+                else:
+                    next_step = None
+                bodies = step.write_bodies(step_number, output_dir, *options)
+                f.write(StepTable.entry(step, bodies, next_step) + '\n')
+        with open(os.path.join(output_dir, '__init__.py'), 'w') as f:
+            f.write('\n'.join(module_header) + compact_template)
+        return
+
+    module_str = list(module_header)
+    for step_number, step in enumerate(steps):
+        if step_number + 1 < step_len:
+            next_step = 'StepNumber%s' % (step_number + 1)
+        else:
+            next_step = None
+        module_str.append(step.serialize(
+            step_number, next_step, output_dir, *options))
+        module_str.append('')
+
+    init = os.path.join(output_dir, '__init__.py')
+    with open(init, 'w') as f:
+        f.write('\n'.join(module_str))
+
+
+def merge_journals(journal_dir, output_dir=None, compact=False,
+                   blob_store=None, compression=None, compress_threshold=0,
+                   remove_journals=False):
+    """Merge the worker journals of a ``per_process`` :class:`Recorder`
+    into one recording
+
+    The steps of every ``worker_<pid>`` journal under ``journal_dir``
+    are saved in the order their requests started to ``output_dir``
+    (the ``journal_dir`` itself by default). The other options are
+    those of :func:`save_recording`. The worker journals are deleted
+    once merged with ``remove_journals=True``.
+
+    """
+    workers = sorted(
+        name for name in os.listdir(journal_dir) if name.startswith(
+            'worker_') and os.path.isdir(os.path.join(journal_dir, name)))
+    steps = []
+    for name in workers:
+        recording = load_recording(os.path.join(journal_dir, name))
+        steps.extend(InteractionStep.from_recorded(step)
+                     for step in iter_steps(recording))
+    steps.sort(key=lambda step: (step.timing or {}).get('started', 0))
+    save_recording(steps, output_dir or journal_dir, compact, blob_store,
+                   compression, compress_threshold)
+    if remove_journals:
+        for name in workers:
+            shutil.rmtree(os.path.join(journal_dir, name))
+    return True
+
+
+def convert_recording(playback_dir, archive_path):
+    """Convert a recording saved by :meth:`Recorder.save` into a
+    :class:`RecordingArchive`"""
+    recording = load_recording(playback_dir)
+    steps = [InteractionStep.from_recorded(step)
+             for step in iter_steps(recording)]
+    RecordingArchive(archive_path).write(steps)
+    return True
+
 
 ## Used by generated Python modules
 
+class RecordedStep(object):
+    """Base class for recorded steps that aren't generated code"""
+    recorded_request = recorded_response = recorded_timing = None
+    recorded_connection = None
+    next_step = 'None'
+
+    def handle_request(self, request):
+        request_match(request, self.recorded_request)
+        return (self.next_step, create_response(self.recorded_response))
+
+
+def _will_close(version, header_map):
+    """Whether a response closes its connection, going by its version
+    and headers the way :class:`httplib.HTTPResponse` does"""
+    connection = header_map.get('connection', '').lower()
+    if version == 11:
+        return 'close' in connection
+    return not ('keep-alive' in connection or 'keep-alive' in header_map or
+                'keep-alive' in header_map.get('proxy-connection',
+                                               '').lower())
+
+
+class ResponseTemplate(object):
+    """The parts of a recorded response shared by every playback of it
+
+    The headers are folded the way :class:`httplib.HTTPMessage` would
+    (lower-case names, the last value wins) once, so that responses
+    created from the template only need a view of the body.
+
+    """
+    __slots__ = ('status', 'version', 'reason', 'headers', 'header_map',
+                 'body', 'will_close', '_source', '_length')
+
+    def __init__(self, response):
+        self.status = response['status']
+        self.version = response['version']
+        self.reason = response['reason']
+        self.body = response['body']
+        header_map = {}
+        names = []
+        for header, value in response['headers']:
+            name = header.lower()
+            if name not in header_map:
+                names.append(name)
+            header_map[name] = value
+        self.header_map = header_map
+        self.headers = tuple((name, header_map[name]) for name in names)
+        self.will_close = _will_close(self.version, header_map)
+        self._source = (response['headers'], self.body, self.status,
+                        self.version, self.reason)
+        self._length = None
+
+    def current(self, response):
+        """Whether the template still reflects the response dict"""
+        source = self._source
+        return (source[0] is response['headers'] and
+                source[1] is response['body'] and
+                source[2] == response['status'] and
+                source[3] == response['version'] and
+                source[4] == response['reason'])
+
+    def length(self):
+        """The (cached) length of the body"""
+        if self._length is None:
+            if isinstance(self.body, FileWrapper):
+                self._length = _body_length(self.body)
+            else:
+                self._length = len(self.body or '')
+        return self._length
+
+    def open(self):
+        """Return a new file-like object reading the body"""
+        body = self.body
+        if isinstance(body, FileWrapper):
+            return body.open()
+        if isinstance(body, str):
+            return cStringIO.StringIO(body)
+        return StringIO.StringIO(body)
+
+    def message(self):
+        """Build an :class:`httplib.HTTPMessage` holding the headers"""
+        msg = httplib.HTTPMessage(StringIO.StringIO(), 0)
+        for name, value in self.headers:
+            msg[name] = value
+        msg.fp = None
+        return msg
+
+
+# Templates of the recorded responses played back, by id of the response
+# dict, holding on to the dict so its id can't be reused while cached
+_response_templates = {}
+response_template_limit = 4096
+
+
+def response_template(response):
+    """Return the (cached) :class:`ResponseTemplate` for a response dict
+
+    A cached template is rebuilt when the dict has been changed since.
+
+    """
+    if isinstance(response, _DecodedDict):
+        return ResponseTemplate(response)
+    key = id(response)
+    cached = _response_templates.get(key)
+    if cached is not None and cached[0] is response and \
+            cached[1].current(response):
+        if _instrument is not None:
+            _instrument.count('cache.response_template.hit')
+        return cached[1]
+    if _instrument is not None:
+        _instrument.count('cache.response_template.miss')
+    template = ResponseTemplate(response)
+    if len(_response_templates) >= response_template_limit:
+        _response_templates.clear()
+    _response_templates[key] = (response, template)
+    return template
+
+
+_empty_body = cStringIO.StringIO('')
+
+
 class DaltonHTTPResponse(object):
+    __slots__ = ('status', 'version', 'reason', 'will_close', 'recv',
+                 '_template', '_content', '_msg', '_pace', '__weakref__')
+
     def __init__(self, response=None):
-        self._content = None
-        self._headers = {}
-        self.msg = httplib.HTTPMessage(StringIO.StringIO(), 0)
+        self._msg = None
+        self._pace = None
         if response:
-            headers = response['headers']
-            for header, value in headers:
-                self.msg[header] = value
-            self.msg.fp = None
-            self.status = response['status']
-            self.version = response['version']
-            self.reason = response['reason']
-            body = response['body']
-            if isinstance(body, FileWrapper):
-                body = body.load()
-            self._content = StringIO.StringIO(body)
+            template = response_template(response)
+            self._template = template
+            self.status = template.status
+            self.version = template.version
+            self.reason = template.reason
+            self.will_close = template.will_close
+            self._content = template.open()
+        else:
+            self._template = None
+            self._content = None
+            self.will_close = False
+
+    @property
+    def msg(self):
+        """The headers as an :class:`httplib.HTTPMessage`, built on first
+        use"""
+        if self._msg is None:
+            if self._template is not None:
+                self._msg = self._template.message()
+            else:
+                self._msg = httplib.HTTPMessage(StringIO.StringIO(), 0)
+        return self._msg
+
+    @msg.setter
+    def msg(self, msg):
+        self._msg = msg
+
+    def throttle(self, seconds):
+        """Spread the delivery of the body over ``seconds``
+
+        Reads then block until the share of the body read so far is
+        due, as if it were arriving over the network.
+
+        """
+        if self._template is None or seconds <= 0:
+            return
+        length = self._template.length()
+        if length:
+            self._pace = [time.time(), seconds / float(length), 0]
+
+    def _wait(self, count):
+        pace = self._pace
+        pace[2] += count
+        delay = pace[0] + pace[1] * pace[2] - time.time()
+        if delay > 0:
+            time.sleep(delay)
 
     def read(self, amt=None):
         if self._content is None:
             raise httplib.ResponseNotReady()
-        return self._content.read(amt)
+        if amt is None:
+            data = self._content.read()
+        else:
+            data = self._content.read(amt)
+        if self._pace is not None:
+            self._wait(len(data))
+        if _instrument is not None:
+            _instrument.count('replayed.bytes', len(data))
+        return data
 
-    def getheader(self, name, default=None):
-        if self.msg is None:
+    def readinto(self, b):
+        if self._content is None:
             raise httplib.ResponseNotReady()
-        return self.msg.getheader(name, default)
+        if hasattr(self._content, 'readinto'):
+            count = self._content.readinto(b)
+        else:
+            data = self._content.read(len(b))
+            b[:len(data)] = data
+            count = len(data)
+        if self._pace is not None:
+            self._wait(count)
+        if _instrument is not None:
+            _instrument.count('replayed.bytes', count)
+        return count
+
+    def getheader(self, name, default=None):
+        if self._msg is not None or self._template is None:
+            return self.msg.getheader(name, default)
+        return self._template.header_map.get(name.lower(), default)
 
     def getheaders(self):
-        if self.msg is None:
-            raise httplib.ResponseNotReady()
-        return self.msg.items()
+        if self._msg is not None or self._template is None:
+            return self.msg.items()
+        return list(self._template.headers)
 
     def close(self):
-        pass
+        if hasattr(self._content, 'close'):
+            self._content.close()
+            # Like httplib, a closed response reads as empty
+            self._content = _empty_body
+
 
+class MismatchError(AssertionError):
+    """Raised when a request doesn't match the recorded request
 
-def request_match(request, recorded_request_dict):
-    assert request.method == recorded_request_dict['method']
-    assert request.url == recorded_request_dict['url']
+    ``differences`` lists a ``(part, requested, recorded)`` tuple for
+    every part of the normalized requests that differs.
+
+    """
+    def __init__(self, request, recorded_request, differences):
+        self.request = request
+        self.recorded_request = recorded_request
+        self.differences = differences
+        lines = ["%s %s doesn't match the recorded %s %s:" % (
+            request.method, request.url, recorded_request['method'],
+            recorded_request['url'])]
+        for part, requested, recorded in differences:
+            lines.append('  %s: %r != %r' % (part, requested, recorded))
+        AssertionError.__init__(self, '\n'.join(lines))
+
+
+class Matcher(object):
+    """Rules deciding whether a request matches a recorded request
+
+    The rules are compiled into a normalized key for each request, and
+    two requests match when their keys are equal. By default only the
+    method and the exact URL are compared.
+
+    ``ignore_params``
+        Query parameters left out of the URL, the remaining parameters
+        are compared regardless of their order.
+    ``headers``
+        Names of headers that must be equal, compared case-insensitively
+        and regardless of order.
+    ``body``
+        Compare the bodies. With ``json_body=True`` bodies that are JSON
+        are compared by their content rather than their formatting,
+        which needs the bodies themselves rather than a
+        :class:`BodyDigest`.
+    ``url_templates``
+        Paths such as ``'/users/{id}'``, a path matching a template
+        matches any other path matching the same template.
+    ``cache_size``
+        The number of recorded request keys kept, 0 to not keep any.
+
+    """
+    def __init__(self, ignore_params=None, headers=(), body=False,
+                 json_body=False, url_templates=(), cache_size=4096):
+        self.ignore_params = ignore_params
+        self.headers = tuple(sorted(set(name.lower() for name in headers)))
+        self.body = body or json_body
+        self.json_body = json_body
+        self.url_templates = tuple(url_templates)
+        # Templates are grouped by their number of path segments, so a
+        # path is only tried against templates of the same shape
+        self._routes = {}
+        for template in self.url_templates:
+            path = template.split('?', 1)[0]
+            pattern = re.sub(r'\\\{[^/]*?\\\}', '[^/]+', re.escape(path))
+            self._routes.setdefault(path.count('/'), []).append(
+                (re.compile(pattern + '$'), path))
+        # Keys of the recorded requests, by id of the request dict
+        self._recorded_keys = {}
+        self.cache_size = cache_size
+
+    def _url(self, url):
+        if self.ignore_params is None and not self._routes:
+            return url
+        path, sep, query = url.partition('?')
+        for regex, template in self._routes.get(path.count('/'), ()):
+            if regex.match(path):
+                path = template
+                break
+        if self.ignore_params is None:
+            return path + sep + query
+        params = tuple(sorted(
+            (name, value) for name, value in
+            urlparse.parse_qsl(query, keep_blank_values=True)
+            if name not in self.ignore_params))
+        return (path, params)
+
+    def _body(self, body):
+        if not body:
+            return None
+        if self.json_body:
+            if isinstance(body, BodyDigest):
+                raise Exception("A json_body matcher can't compare a body "
+                                "that is only known by its digest.")
+            content = ''.join(str(chunk) for chunk in _iter_body(body))
+            try:
+                return json.dumps(json.loads(content), sort_keys=True,
+                                  separators=(',', ':'))
+            except ValueError:
+                return content
+        return body_digest(body)
+
+    def key(self, method, url, body=None, headers=None):
+        """Return the normalized key of a request"""
+        if self.headers:
+            lowered = dict((name.lower(), str(value).strip())
+                           for name, value in (headers or {}).items())
+            selected = tuple(lowered.get(name) for name in self.headers)
+        else:
+            selected = ()
+        return (method, self._url(url),
+                self._body(body) if self.body else None, selected)
+
+    def recorded_key(self, recorded_request):
+        """Return the (cached) key of a recorded request dict"""
+        if not self.cache_size or \
+                isinstance(recorded_request, _DecodedDict):
+            return self.key(recorded_request['method'],
+                            recorded_request['url'],
+                            recorded_request.get('body'),
+                            recorded_request.get('headers'))
+        cached = self._recorded_keys.get(id(recorded_request))
+        if cached is not None and cached[0] is recorded_request:
+            if _instrument is not None:
+                _instrument.count('cache.matcher.hit')
+            return cached[1]
+        if _instrument is not None:
+            _instrument.count('cache.matcher.miss')
+        key = self.key(recorded_request['method'], recorded_request['url'],
+                       recorded_request.get('body'),
+                       recorded_request.get('headers'))
+        if len(self._recorded_keys) >= self.cache_size:
+            self._recorded_keys.clear()
+        self._recorded_keys[id(recorded_request)] = (recorded_request, key)
+        return key
+
+    def differences(self, request, recorded_request):
+        """Return the ``(part, requested, recorded)`` differences between
+        a request and a recorded request dict"""
+        requested = self.key(request.method, request.url,
+                             getattr(request, 'body', None),
+                             getattr(request, 'headers', None))
+        recorded = self.recorded_key(recorded_request)
+        if requested == recorded:
+            return []
+        differences = []
+        for part, mine, theirs in zip(('method', 'url', 'body'),
+                                      requested, recorded):
+            if mine != theirs:
+                differences.append((part, mine, theirs))
+        for name, mine, theirs in zip(self.headers, requested[3],
+                                      recorded[3]):
+            if mine != theirs:
+                differences.append(('header %s' % name, mine, theirs))
+        return differences
+
+
+# Used by request_match outside of a player, so it keeps no cache; a
+# player matches with a matcher of its own
+default_matcher = Matcher(cache_size=0)
+
+
+def request_match(request, recorded_request_dict, matcher=None):
+    """Check that the request matches the recorded request
+
+    The request is compared with the ``matcher``, or the one the player
+    put on the request, or else only the method and URL must be equal.
+    Raises a :class:`MismatchError` describing the differences if it
+    doesn't match.
+
+    """
+    matcher = matcher or getattr(request, 'matcher', None) or \
+        default_matcher
+    differences = matcher.differences(request, recorded_request_dict)
+    if differences:
+        raise MismatchError(request, recorded_request_dict, differences)
     return True
 
 
@@ -320,81 +2685,387 @@ def create_response(response_dict):
     return DaltonHTTPResponse(response_dict)
 
 
+def request_fingerprint(method, url, body=None, headers=None,
+                        match_headers=(), host=None):
+    """Return a hashable key identifying a request
+
+    The key is made from the host, method, URL, a digest of the body
+    and the values of the (lower-case) ``match_headers``.
+
+    """
+    if match_headers:
+        lowered = dict((name.lower(), value)
+                       for name, value in (headers or {}).items())
+        selected = tuple(lowered.get(name) for name in match_headers)
+    else:
+        selected = ()
+    return (host, method, url, body_digest(body), selected)
+
+
+def body_digest(body):
+    """Return the SHA-1 hex digest of a body, or None for no body
+
+    The body may be a string, a :class:`FileWrapper`, a
+    :class:`BodyDigest` or a seekable file-like object, which is read
+    in chunks and rewound.
+
+    """
+    if isinstance(body, BodyDigest):
+        return body.sha1
+    if not body:
+        return None
+    digest = hashlib.sha1()
+    if isinstance(body, basestring):
+        digest.update(body)
+        return digest.hexdigest()
+    if hasattr(body, 'open'):
+        source = body.open()
+        chunk = source.readbuffer(65536)
+        while chunk:
+            digest.update(chunk)
+            chunk = source.readbuffer(65536)
+        source.close()
+    else:
+        start = body.tell()
+        chunk = body.read(65536)
+        while chunk:
+            digest.update(chunk)
+            chunk = body.read(65536)
+        body.seek(start)
+    return digest.hexdigest()
+
+
 ## HTTPConnection monkey-patch methods
 
 def _request(self, method, url, body=None, headers=None):
     """Monkey-patched replacement request method"""
     headers = headers or {}
     intercept = self._intercept()
-    if 'recorder' in intercept:
-        intercept['recorder']._record_request(self.host, method, url, 
-                                              body, headers)
-    
-    if intercept['mode'] == 'normal':
-        return self._orig_request(method, url, body, headers)
-    else:
-        return intercept['playback'].request(method, url, body, headers)
+    if intercept['mode'] != 'normal':
+        if _is_iterable(body) and not intercept['playback']._digest_bodies:
+            body = _spool_iterable(body)
+        return intercept['playback'].request(method, url, body, headers,
+                                             host=self.host, connection=self)
+
+    recorder = intercept.get('recorder')
+    if recorder:
+        if _is_iterable(body):
+            body = _spool_iterable(body)
+        if hasattr(body, 'read'):
+            recorder._record_request(self.host, method, url, None, headers,
+                                     connection=self)
+            body = RequestTee(body, self, recorder._record_body)
+        else:
+            recorder._record_request(self.host, method, url, body, headers,
+                                     connection=self)
+    return _call_recording(self, recorder, self._orig_request, method, url,
+                           body, headers)
 
 
 def _getresponse(self):
     """Monkey-patched replacement getresponse method"""
-    intercept = self._intercept()
+    pending = self.__dict__.pop('_dalton_pending', None)
+    if pending:
+        intercept = pending['intercept']
+    else:
+        intercept = self._intercept()
     if intercept['mode'] == 'normal':
         response = self._orig_getresponse()
-        if 'recorder' in intercept:
-            intercept['recorder']._record_response(response)
-            
-            # Ensure chunked is not set, since the StringIO replacement
-            # goofs it up
-            response.chunked = 0
+        recorder = intercept.get('recorder')
+        if recorder is not None:
+            if _instrument is not None:
+                _measure('record_response', recorder._record_response,
+                         response, self)
+            else:
+                recorder._record_response(response, connection=self)
         return response
     else:
-        return intercept['playback'].getresponse()
+        player = intercept['playback']
+        if pending:
+            body = pending['body']
+            if isinstance(body, BodyHasher):
+                body = body.result()
+            elif body is not None:
+                body.seek(0)
+            player.request(pending['method'], pending['url'], body,
+                           pending['headers'], host=self.host,
+                           connection=self)
+        return player.getresponse(connection=self)
+
+
+## The low-level request API
+#
+# A request sent with putrequest/putheader/endheaders/send is recorded
+# (or played back) by collecting its parts on the connection until
+# getresponse. While dalton itself calls the original methods (request
+# calls all of them, and putrequest calls putheader for the Host header)
+# the ``_dalton_call`` flag makes the patched methods pass straight
+# through.
+
+def _call_original(self, method, *args):
+    state = self.__dict__
+    state['_dalton_call'] = True
+    try:
+        return method(*args)
+    finally:
+        state['_dalton_call'] = False
+
+
+def _call_recording(self, recorder, method, *args):
+    """Call an original method, and if it fails (to connect, say)
+    forget the request the recorder is waiting to see the response of"""
+    try:
+        return _call_original(self, method, *args)
+    except Exception:
+        if recorder:
+            recorder._discard_request(self)
+        raise
+
+
+def _putrequest(self, method, url, *args, **kwargs):
+    """Monkey-patched replacement putrequest method"""
+    state = self.__dict__
+    state.pop('_dalton_pending', None)
+    if state.get('_dalton_call'):
+        return self._orig_putrequest(method, url, *args, **kwargs)
+    intercept = self._intercept()
+    if intercept is _passthrough:
+        return self._orig_putrequest(method, url, *args, **kwargs)
+
+    pending = {'intercept': intercept, 'method': method, 'url': url,
+               'headers': {}, 'body': None}
+    state['_dalton_pending'] = pending
+    if intercept['mode'] != 'normal':
+        return
+    recorder = intercept.get('recorder')
+    if recorder:
+        # The headers are filled in as putheader is called
+        recorder._record_request(self.host, method, url, None,
+                                 pending['headers'], connection=self)
+    state['_dalton_call'] = True
+    try:
+        return self._orig_putrequest(method, url, *args, **kwargs)
+    except Exception:
+        if recorder:
+            recorder._discard_request(self)
+        raise
+    finally:
+        state['_dalton_call'] = False
+
+
+def _putheader(self, header, *values):
+    """Monkey-patched replacement putheader method"""
+    state = self.__dict__
+    pending = state.get('_dalton_pending')
+    if pending is None or state.get('_dalton_call'):
+        return self._orig_putheader(header, *values)
+    pending['headers'][header] = '\r\n\t'.join(str(v) for v in values)
+    if pending['intercept']['mode'] == 'normal':
+        return self._orig_putheader(header, *values)
+
+
+def _endheaders(self, message_body=None):
+    """Monkey-patched replacement endheaders method"""
+    state = self.__dict__
+    pending = state.get('_dalton_pending')
+    if pending is None or state.get('_dalton_call'):
+        return self._orig_endheaders(message_body)
+    if message_body is not None:
+        message_body = _tee_sent(self, pending, message_body)
+    if pending['intercept']['mode'] == 'normal':
+        return _call_recording(self, pending['intercept'].get('recorder'),
+                               self._orig_endheaders, message_body)
+
+
+def _send(self, data):
+    """Monkey-patched replacement send method"""
+    state = self.__dict__
+    pending = state.get('_dalton_pending')
+    if pending is None or state.get('_dalton_call'):
+        return self._orig_send(data)
+    data = _tee_sent(self, pending, data)
+    if pending['intercept']['mode'] == 'normal':
+        return _call_recording(self, pending['intercept'].get('recorder'),
+                               self._orig_send, data)
+
+
+def _tee_sent(self, pending, data):
+    """Record request body data sent with the low-level API, returning
+    what to send in its place"""
+    recorder = pending['intercept'].get('recorder')
+    if recorder:
+        if hasattr(data, 'read'):
+            return RequestTee(data, self, recorder._record_body)
+        recorder._record_body(data, self)
+        return data
+
+    if pending['intercept']['mode'] == 'normal':
+        return data
+    # Playing back, nothing is sent and the body is only matched
+    if pending['intercept']['playback']._digest_bodies:
+        if pending['body'] is None:
+            pending['body'] = BodyHasher()
+        for chunk in _read_chunks(data):
+            pending['body'].update(chunk)
+        return data
+    if pending['body'] is None:
+        pending['body'] = tempfile.SpooledTemporaryFile(
+            max_size=1024 * 1024)
+    for chunk in _read_chunks(data):
+        pending['body'].write(chunk)
+    return data
+
+
+def _close(self):
+    """Monkey-patched replacement close method"""
+    self.__dict__.pop('_dalton_socket', None)
+    return self._orig_close()
+
+
+def _is_iterable(body):
+    """Whether a body is an iterable of chunks rather than a string or
+    a file-like object"""
+    return body is not None and not isinstance(body, basestring) and \
+        not hasattr(body, 'read') and hasattr(body, '__iter__')
+
+
+def _spool_iterable(body, max_size=1024 * 1024):
+    """Gather an iterable body into a spool file, which is kept in
+    memory up to ``max_size`` bytes"""
+    spool = tempfile.SpooledTemporaryFile(max_size=max_size)
+    for chunk in body:
+        spool.write(chunk)
+    spool.seek(0)
+    return spool
+
+
+class RequestTee(object):
+    """Wraps a file-like request body, handing every chunk httplib reads
+    from it to ``record(chunk, connection)``"""
+    def __init__(self, body, connection, record):
+        self._body = body
+        self._connection = connection
+        self._record = record
+
+    def read(self, amt=-1):
+        data = self._body.read(amt)
+        if data:
+            self._record(data, self._connection)
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self._body, name)
 
 
 def _intercept(self):
-    """Monkey-patch intercept to determine call-stack location"""
-    i_vars = _registered_injections.callers
-    if not i_vars:
-        return {'mode': 'normal'}
-    if _registered_injections._global:
-        return _registered_injections.callers['_global']
-    
-    result = None
-    
-    cur_frame = inspect.currentframe()
-    stack = inspect.getouterframes(cur_frame)
-    for frame_record in stack:
-        frame = frame_record[0]
-        
-        # Look up the stack for a variable indicating we should
-        # get involved
-        if 'self' not in frame.f_locals:
-            continue
-            
-        frame_self = frame.f_locals['self']
-        for key in i_vars:
-            if frame_self.__class__ == key or frame_self == key:
-                result = i_vars[key]
-                break
+    """Monkey-patch intercept to determine the injection for this
+    connection"""
+    registry = _registered_injections
+    scopes = registry.scopes
+    if scopes:
+        return scopes[-1]
 
-    # Cycles can be problematic depending on Python GC mode, explicitly
-    # remove the frame references
-    del cur_frame
-    while stack:
-        frame_record = stack.pop()
-        del frame_record
-    if result:
-        return result
-    else:
-        return {'mode': 'normal'}
+    callers = registry.callers
+    if callers:
+        result = callers.get(self)
+        if result is not None:
+            return result
+        for cls in _class_mro(self.__class__):
+            result = callers.get(cls)
+            if result is not None:
+                return result
+
+    if registry.stack_callers:
+        result = _intercept_from_stack(registry.stack_callers)
+        if result is not None:
+            return result
+    return _passthrough
+
+_passthrough = {'mode': 'normal'}
+
+
+def _timed_intercept(self):
+    """The intercept installed while an instrument is set, reporting
+    how long resolving it took and what it decided"""
+    instrument = _instrument
+    start = time.time()
+    result = _intercept(self)
+    if instrument is not None:
+        instrument.timing('intercept', time.time() - start)
+        if result is _passthrough:
+            instrument.count('intercept.passthrough')
+        elif result['mode'] == 'playback':
+            instrument.count('intercept.playback')
+        else:
+            instrument.count('intercept.record')
+    return result
+
+
+_mro_cache = {}
+
+def _class_mro(cls):
+    """Return the (cached) method resolution order of a connection
+    class"""
+    mro = _mro_cache.get(cls)
+    if mro is None:
+        mro = _mro_cache[cls] = inspect.getmro(cls)
+    return mro
+
+
+def _intercept_from_stack(stack_callers):
+    """Walk the call-stack for a registered caller
+
+    The outermost frame whose ``self`` is a registered caller (or an
+    instance of one) wins.
+
+    """
+    result = None
+    frame = sys._getframe(2)
+    try:
+        while frame is not None:
+            frame_self = frame.f_locals.get('self')
+            if frame_self is not None:
+                try:
+                    found = stack_callers.get(frame_self)
+                    if found is None:
+                        found = stack_callers.get(frame_self.__class__)
+                except TypeError:
+                    # Unhashable objects can't be registered callers
+                    found = None
+                if found is not None:
+                    result = found
+            frame = frame.f_back
+    finally:
+        # Cycles can be problematic depending on Python GC mode,
+        # explicitly remove the frame reference
+        del frame
+    return result
 
 
 ## String templates used for Python module generation
 
+module_header = [
+    'import os', 'import dalton', 'from dalton import FileWrapper', '',
+    'here = os.path.abspath(os.path.dirname(__file__))', ''
+]
+
+truncated_marker = '\n[dalton: body truncated from %s bytes]'
+
+compact_template = """
+steps = dalton.StepTable(os.path.join(here, 'steps.jsonl'))
+
+# The steps are decoded from steps.jsonl as playback reaches them. A step
+# is customized by subclassing its recorded version, for example:
+#
+# class StepNumber0(steps.step(0)):
+#     def handle_request(self, request):
+#         return super(StepNumber0, self).handle_request(request)
+"""
+
 step_template = """\
 class StepNumber%(step_number)s(object):
     recorded_request = {
+        'host': %(host)r,
         'headers':  %(request_headers)s,
         'url': '%(request_url)s',
         'method': '%(request_method)s',
@@ -408,8 +3079,10 @@ class StepNumber%(step_number)s(object):
         'version': %(response_version)s,
     }
     next_step = '%(next_step)s'
-    
+    recorded_timing = %(timing)r
+    recorded_connection = %(connection)r
+
     def handle_request(self, request):
-        assert dalton.request_match(request, self.recorded_request)
+        dalton.request_match(request, self.recorded_request)
         return (self.next_step, dalton.create_response(self.recorded_response))
 """
@@ -0,0 +1,220 @@
+"""Benchmarks for dalton's hot paths
+
+Every benchmark runs against a local :class:`dalton.server.StandInServer`
+or synthetic recordings, so no network access is needed. Results are a
+list of dicts, one per measurement, which the ``dalton bench`` command
+writes out as JSON for regression tracking::
+
+    {"benchmark": "record", "params": {"body_size": 65536, ...},
+     "ops": 50, "seconds": 0.12, "per_op_us": 2400.0, "mb_per_sec": 27.1}
+
+"""
+import httplib
+import os
+import shutil
+import tempfile
+import time
+
+import dalton
+from dalton.server import StandInServer, start_in_thread
+
+
+def _result(name, params, ops, seconds, nbytes=None):
+    result = {
+        'benchmark': name,
+        'params': params,
+        'ops': ops,
+        'seconds': seconds,
+        'per_op_us': seconds / ops * 1e6,
+    }
+    if nbytes is not None:
+        result['mb_per_sec'] = nbytes / seconds / (1024.0 * 1024.0)
+    return result
+
+
+def _timed(func, ops):
+    start = time.time()
+    for i in xrange(ops):
+        func()
+    return time.time() - start
+
+
+def _fetch(h, path):
+    h.request('GET', path)
+    return h.getresponse().read()
+
+
+def bench_passthrough(address, ops):
+    """Raw HTTPConnection requests vs requests through the injected
+    (but not intercepting) methods"""
+    results = []
+    h = httplib.HTTPConnection(*address)
+    fetch = lambda: _fetch(h, '/a')
+    fetch()
+    results.append(_result('passthrough', {'patched': False}, ops,
+                           _timed(fetch, ops)))
+
+    # An active recorder for another connection installs the patches
+    other = dalton.Recorder(caller=httplib.HTTPConnection('localhost'))
+    with other.recording():
+        results.append(_result('passthrough', {'patched': True}, ops,
+                               _timed(fetch, ops)))
+    h.close()
+    return results
+
+
+def bench_intercept(ops, depths=(1, 10, 50), callers=(1, 10, 100)):
+    """Cost of resolving the intercept for a connection as the stack
+    depth and number of registered callers grow"""
+    results = []
+    h = httplib.HTTPConnection('localhost')
+
+    def nested(depth, func):
+        if depth <= 1:
+            return func()
+        return nested(depth - 1, func)
+
+    class Caller(object):
+        def call(self, depth, func):
+            return nested(depth, func)
+
+    for walk_stack in (False, True):
+        for count in callers:
+            if walk_stack:
+                owners = [Caller() for i in range(count)]
+            else:
+                owners = [httplib.HTTPConnection('localhost')
+                          for i in range(count - 1)] + [h]
+            recorders = [dalton.Recorder(caller=owner, walk_stack=walk_stack)
+                         for owner in owners]
+            for recorder in recorders:
+                recorder.start()
+            try:
+                for depth in depths:
+                    intercept = lambda: dalton._intercept(h)
+                    caller = owners[-1]
+                    if walk_stack:
+                        func = lambda: caller.call(depth, intercept)
+                    else:
+                        func = lambda: nested(depth, intercept)
+                    # Subtract the cost of getting to that stack depth
+                    baseline = _timed(lambda: nested(depth, lambda: None),
+                                      ops)
+                    seconds = _timed(func, ops) - baseline
+                    results.append(_result(
+                        'intercept', {'walk_stack': walk_stack,
+                                      'callers': count, 'depth': depth},
+                        ops, max(seconds, 0.0)))
+            finally:
+                for recorder in recorders:
+                    recorder.stop()
+    return results
+
+
+def bench_record(address, ops, sizes=(1024, 65536, 1024 * 1024)):
+    """Recorder throughput as the response body size grows"""
+    results = []
+    for streaming in (False, True):
+        for size in sizes:
+            h = httplib.HTTPConnection(*address)
+            recorder = dalton.Recorder(caller=h, streaming=streaming)
+            path = '/size/%s' % size
+            with recorder.recording():
+                seconds = _timed(lambda: _fetch(h, path), ops)
+            h.close()
+            results.append(_result(
+                'record', {'streaming': streaming, 'body_size': size},
+                ops, seconds, size * ops))
+    return results
+
+
+def _synthetic_steps(count, body_size=64):
+    steps = []
+    for number in range(count):
+        step = dalton.InteractionStep(host='localhost')
+        step.request_method = 'GET'
+        step.request_url = '/%s' % number
+        step.response_status = 200
+        step.response_reason = 'OK'
+        step.response_version = 11
+        step.response_headers = [('content-type', 'text/plain')]
+        step.response_body = 'x' * body_size
+        steps.append(step)
+    return steps
+
+
+def bench_playback(work_dir, lengths=(10, 100, 1000)):
+    """Player step lookup latency as the recording grows, for archive
+    recordings played in sequence and by index"""
+    results = []
+    for length in lengths:
+        archive = os.path.join(work_dir, 'playback_%s.dalton' % length)
+        dalton.RecordingArchive(archive).write(_synthetic_steps(length))
+        for match in ('sequence', 'index'):
+            start = time.time()
+            player = dalton.Player(archive, use_global=True, match=match)
+            load = time.time() - start
+            start = time.time()
+            for number in range(length):
+                player.request('GET', '/%s' % number, host='localhost')
+                player.getresponse()
+            seconds = time.time() - start
+            results.append(_result(
+                'playback', {'match': match, 'steps': length,
+                             'load_seconds': load}, length, seconds))
+    return results
+
+
+def bench_response_read(work_dir, ops, sizes=(1024, 65536, 1024 * 1024),
+                        chunk=65536):
+    """DaltonHTTPResponse read throughput for in-memory and file bodies"""
+    results = []
+    for size in sizes:
+        wrapper = dalton.FileWrapper('body_%s.txt' % size, work_dir)
+        wrapper.write('x' * size)
+        for source, body in (('string', 'x' * size), ('file', wrapper)):
+            response_dict = {'headers': [], 'status': 200, 'reason': 'OK',
+                             'version': 11, 'body': body}
+
+            def read():
+                response = dalton.DaltonHTTPResponse(response_dict)
+                while response.read(chunk):
+                    pass
+                response.close()
+            results.append(_result(
+                'response_read', {'body': source, 'body_size': size},
+                ops, _timed(read, ops), size * ops))
+    return results
+
+
+benchmarks = ['passthrough', 'intercept', 'record', 'playback',
+              'response_read']
+
+
+def run(only=None, quick=False):
+    """Run the benchmarks (or the ``only`` ones named), returning the
+    list of results"""
+    ops = 20 if quick else 200
+    only = only or benchmarks
+    dalton.inject()
+    server = StandInServer()
+    address = start_in_thread(server)
+    work_dir = tempfile.mkdtemp()
+    results = []
+    try:
+        if 'passthrough' in only:
+            results.extend(bench_passthrough(address, ops))
+        if 'intercept' in only:
+            results.extend(bench_intercept(ops * 50))
+        if 'record' in only:
+            results.extend(bench_record(address, max(ops / 4, 5)))
+        if 'playback' in only:
+            results.extend(bench_playback(
+                work_dir, (10, 100) if quick else (10, 100, 1000, 10000)))
+        if 'response_read' in only:
+            results.extend(bench_response_read(work_dir, ops))
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(work_dir)
+    return results
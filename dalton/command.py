@@ -0,0 +1,205 @@
+"""The ``dalton`` command-line tool"""
+import argparse
+import json
+import os
+import sys
+import time
+
+
+def serve(options):
+    from dalton.server import create_server
+    server = create_server(options.recording, host=options.host,
+                           port=options.port, match=options.match,
+                           cursor=options.cursor,
+                           match_headers=options.match_header,
+                           verbose=options.verbose,
+                           latency_scale=options.latency_scale)
+    host, port = server.server_address
+    print 'Serving %s on http://%s:%s/' % (options.recording, host, port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def bench(options):
+    from dalton.bench import run
+    results = run(only=options.only, quick=options.quick)
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print output
+
+
+def compact(options):
+    from dalton.maintenance import compact_tree, summarize, volatile_headers
+    start = time.time()
+    compression = None if options.compression == 'none' else \
+        options.compression
+    results = compact_tree(
+        options.root, processes=options.processes,
+        strip_headers=options.strip_header or volatile_headers,
+        dedupe=options.dedupe, compression=compression,
+        compress_threshold=options.compress_threshold,
+        step_table=options.step_table, dry_run=options.dry_run)
+    for result in results:
+        if result['status'] == 'compacted':
+            print '%s: %s -> %s steps, %s -> %s bytes (%.2fs)' % (
+                result['recording'], result['steps_before'],
+                result['steps_after'], result['bytes_before'],
+                result['bytes_after'], result['seconds'])
+        elif result['status'] == 'skipped':
+            print '%s: skipped, %s' % (result['recording'], result['reason'])
+        else:
+            print '%s: invalid, %s' % (result['recording'], result['error'])
+    print summarize(results, time.time() - start)
+    if any(result['status'] == 'invalid' for result in results):
+        return 1
+
+
+def verify(options):
+    from dalton import Matcher
+    from dalton.maintenance import find_recordings
+    from dalton.verify import verify_recordings
+    recordings = []
+    for path in options.recordings:
+        if os.path.isdir(path) and \
+                not os.path.exists(os.path.join(path, '__init__.py')):
+            recordings.extend(find_recordings(path))
+        else:
+            recordings.append(path)
+    matcher = None
+    if options.ignore_param:
+        matcher = Matcher(ignore_params=options.ignore_param)
+    start = time.time()
+    results = verify_recordings(
+        recordings, options.target, processes=options.processes,
+        headers=options.header or ['content-type'], matcher=matcher)
+    if options.json:
+        print json.dumps(results, indent=2, sort_keys=True)
+    else:
+        for result in results:
+            latency = result['latency_ms']
+            print '%s: %s, %s steps, %.1f req/s, p50 %.1fms, p95 %.1fms' % (
+                result['recording'], result['status'], result['steps'],
+                result['requests_per_sec'], latency.get('p50', 0),
+                latency.get('p95', 0))
+            if result['status'] == 'error':
+                print '    %s' % result['error']
+            for drift in result['drift']:
+                print '    %(step)s %(method)s %(url)s %(part)s: ' \
+                    '%(recorded)r != %(live)r' % drift
+        print '%s recordings verified in %.2fs, %s drifted, %s failed' % (
+            len(results), time.time() - start,
+            sum(1 for result in results if result['status'] == 'drift'),
+            sum(1 for result in results if result['status'] == 'error'))
+    if any(result['status'] != 'ok' for result in results):
+        return 1
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(
+        prog='dalton', description='Work with dalton HTTP recordings.')
+    commands = parser.add_subparsers(title='commands')
+
+    serve_parser = commands.add_parser(
+        'serve', help='Play back a recording over a local HTTP server.')
+    serve_parser.add_argument(
+        'recording', help='Recording directory or archive file.')
+    serve_parser.add_argument('--host', default='127.0.0.1')
+    serve_parser.add_argument('--port', type=int, default=8000)
+    serve_parser.add_argument(
+        '--match', choices=['index', 'sequence'], default='index',
+        help='Match requests by fingerprint or in recorded order.')
+    serve_parser.add_argument(
+        '--cursor', choices=['shared', 'connection'], default='shared',
+        help='Whether each connection plays the recording on its own.')
+    serve_parser.add_argument(
+        '--match-header', action='append', default=[], metavar='NAME',
+        help='Header to include in request matching, may be repeated.')
+    serve_parser.add_argument(
+        '--latency-scale', type=float, default=0, metavar='FACTOR',
+        help='Reproduce the recorded latency scaled by this factor '
+             '(default: 0, answer immediately).')
+    serve_parser.add_argument('-v', '--verbose', action='store_true',
+                              help='Log every request.')
+    serve_parser.set_defaults(func=serve)
+
+    from dalton.bench import benchmarks
+    bench_parser = commands.add_parser(
+        'bench', help='Benchmark dalton against a local stand-in server.')
+    bench_parser.add_argument(
+        '--only', action='append', choices=benchmarks,
+        help='Benchmark to run, may be repeated (default: all).')
+    bench_parser.add_argument('--quick', action='store_true',
+                              help='Run fewer iterations.')
+    bench_parser.add_argument('-o', '--output',
+                              help='Write the JSON results to this file.')
+    bench_parser.set_defaults(func=bench)
+
+    from dalton.maintenance import volatile_headers
+    compact_parser = commands.add_parser(
+        'compact', help='Validate and compact the recordings in a tree.')
+    compact_parser.add_argument(
+        'root', help='Directory to search for recordings.')
+    compact_parser.add_argument(
+        '-j', '--processes', type=int,
+        help='Number of worker processes (default: one per CPU).')
+    compact_parser.add_argument(
+        '--strip-header', action='append', metavar='NAME',
+        help='Header to remove from every step, may be repeated '
+             '(default: %s).' % ', '.join(volatile_headers))
+    compact_parser.add_argument(
+        '--dedupe', action='store_true',
+        help='Merge identical consecutive steps, which changes the requests '
+             'the recording expects.')
+    compact_parser.add_argument(
+        '--compression', choices=['zlib', 'gzip', 'bz2', 'none'],
+        default='zlib', help='Compression of the bodies (default: zlib).')
+    compact_parser.add_argument(
+        '--compress-threshold', type=int, default=1024, metavar='BYTES',
+        help='Only compress bodies of at least this size.')
+    compact_parser.add_argument(
+        '--step-table', action='store_true',
+        help='Save the steps as a compact step table.')
+    compact_parser.add_argument(
+        '-n', '--dry-run', action='store_true',
+        help='Report what would be saved without changing anything.')
+    compact_parser.set_defaults(func=compact)
+
+    verify_parser = commands.add_parser(
+        'verify', help='Compare recordings with the responses of a live '
+                       'target.')
+    verify_parser.add_argument(
+        'target', help='host:port (or http:// URL) to send the requests to.')
+    verify_parser.add_argument(
+        'recordings', nargs='+', metavar='recording',
+        help='Recording directory or archive, or a directory of them.')
+    verify_parser.add_argument(
+        '-j', '--processes', type=int,
+        help='Number of worker processes (default: one per CPU).')
+    verify_parser.add_argument(
+        '--header', action='append', metavar='NAME',
+        help='Response header to compare, may be repeated '
+             '(default: content-type).')
+    verify_parser.add_argument(
+        '--ignore-param', action='append', metavar='NAME',
+        help='Query parameter to ignore when matching, may be repeated.')
+    verify_parser.add_argument('--json', action='store_true',
+                               help='Print the results as JSON.')
+    verify_parser.set_defaults(func=verify)
+    return parser
+
+
+def main(argv=None):
+    parser = make_parser()
+    options = parser.parse_args(argv)
+    return options.func(options)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
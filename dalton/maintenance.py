@@ -0,0 +1,217 @@
+"""Offline maintenance of saved recordings
+
+:func:`compact_tree` finds the recordings saved by
+:meth:`dalton.Recorder.save` under a directory and compacts each of
+them in a process pool: the recording is validated, volatile headers
+are stripped, and the steps are saved again (with their bodies
+re-encoded) in place of the original. Identical consecutive steps are
+only merged with ``dedupe=True``, as a client replaying the recording
+then has to make the repeated request only once.
+
+Only recordings that are still as generated are rewritten. A recording
+whose steps have been customized (or that has extra code or branches)
+is reported as skipped, as saving it again would lose the changes.
+
+"""
+import multiprocessing
+import os
+import shutil
+import time
+
+import dalton
+
+volatile_headers = ('date', 'set-cookie')
+
+# Names a generated step's handle_request refers to (the assert of
+# recordings saved before RecordedStep adds AssertionError)
+_generated_names = frozenset(['dalton', 'request_match', 'create_response',
+                              'next_step', 'recorded_request',
+                              'recorded_response', 'AssertionError'])
+_step_attributes = frozenset(['__module__', '__doc__', '__dict__',
+                              '__weakref__', 'recorded_request',
+                              'recorded_response', 'recorded_timing',
+                              'recorded_connection', 'next_step',
+                              'handle_request'])
+_module_names = frozenset(['os', 'dalton', 'FileWrapper', 'here', 'steps'])
+
+
+def find_recordings(root):
+    """Return the recording directories under root (or root itself)"""
+    header = '\n'.join(dalton.module_header[:2])
+    recordings = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        if '__init__.py' not in filenames:
+            continue
+        with open(os.path.join(dirpath, '__init__.py'), 'rb') as f:
+            if f.read(len(header)) != header:
+                continue
+        recordings.append(dirpath)
+        # A recording doesn't contain other recordings
+        del dirnames[:]
+    return sorted(recordings)
+
+
+def _tree_size(path):
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            if not filename.endswith('.pyc'):
+                size += os.path.getsize(os.path.join(dirpath, filename))
+    return size
+
+
+def _customization(recording, steps):
+    """Return why a loaded recording isn't as generated, or None"""
+    names = [name for name in vars(recording)
+             if not name.startswith('__') and name not in _module_names]
+    extra = [name for name in names if not name.startswith('StepNumber')]
+    if extra:
+        return 'has code besides the recorded steps: %s' % ', '.join(
+            sorted(extra))
+    if len([name for name in names
+            if getattr(recording, name) is not None]) > len(steps):
+        return 'has steps outside the recorded chain'
+    for step in steps:
+        if not issubclass(step, dalton.RecordedStep):
+            if set(vars(step)) - _step_attributes:
+                return '%s has been customized' % step.__name__
+        code = step.handle_request.im_func.func_code
+        if step.handle_request.im_func is not \
+                dalton.RecordedStep.handle_request.im_func and \
+                set(code.co_names) - _generated_names:
+            return '%s has been customized' % step.__name__
+        for body in (step.recorded_request['body'],
+                     step.recorded_response['body']):
+            if isinstance(body, dalton.BlobWrapper):
+                return '%s refers to a blob store' % step.__name__
+            if isinstance(body, dalton.FileWrapper) and \
+                    not os.path.exists(body.path):
+                raise Exception('%s: missing body file %s' % (
+                    step.__name__, body.path))
+    return None
+
+
+def _strip(step, headers):
+    if step.request_headers:
+        step.request_headers = dict(
+            (name, value) for name, value in step.request_headers.items()
+            if name.lower() not in headers)
+    step.response_headers = [
+        (name, value) for name, value in step.response_headers
+        if name.lower() not in headers]
+
+
+def _identity(step):
+    """What makes two steps identical"""
+    return (step.host, step.request_method, step.request_url,
+            sorted((step.request_headers or {}).items()),
+            dalton.body_digest(step.request_body), step.response_status,
+            step.response_reason, step.response_version,
+            step.response_headers, dalton.body_digest(step.response_body))
+
+
+def compact_recording(path, strip_headers=volatile_headers, dedupe=False,
+                      compression=None, compress_threshold=1024,
+                      step_table=False, dry_run=False):
+    """Compact one recording directory in place
+
+    Returns a dict describing the outcome: its ``status`` is
+    ``'compacted'``, ``'skipped'`` (with the ``reason``) or ``'invalid'``
+    (with the ``error``), along with the number of steps and bytes
+    before and after. With ``dry_run`` the compacted recording is
+    measured and then thrown away.
+
+    """
+    start = time.time()
+    path = os.path.abspath(path)
+    result = {'recording': path, 'bytes_before': _tree_size(path)}
+    try:
+        recording = dalton.load_recording(path)
+        recorded = list(dalton.iter_steps(recording))
+        reason = _customization(recording, recorded)
+    except Exception, e:
+        result.update(status='invalid', error='%s: %s' % (
+            e.__class__.__name__, e), seconds=time.time() - start)
+        return result
+    result['steps_before'] = len(recorded)
+    if reason:
+        result.update(status='skipped', reason=reason,
+                      seconds=time.time() - start)
+        return result
+
+    strip_headers = frozenset(name.lower() for name in strip_headers)
+    steps = []
+    previous = None
+    for step_class in recorded:
+        step = dalton.InteractionStep.from_recorded(step_class)
+        _strip(step, strip_headers)
+        if dedupe:
+            identity = _identity(step)
+            if identity == previous:
+                continue
+            previous = identity
+        steps.append(step)
+
+    output_dir = path + '.compacting'
+    if os.path.exists(output_dir):
+        shutil.rmtree(output_dir)
+    try:
+        dalton.save_recording(steps, output_dir, step_table, None,
+                              compression, compress_threshold)
+        result['bytes_after'] = _tree_size(output_dir)
+        if not dry_run:
+            previous_dir = path + '.precompact'
+            os.rename(path, previous_dir)
+            os.rename(output_dir, path)
+            shutil.rmtree(previous_dir)
+    finally:
+        if os.path.exists(output_dir):
+            shutil.rmtree(output_dir)
+    result.update(status='compacted', steps_after=len(steps),
+                  seconds=time.time() - start)
+    return result
+
+
+def _compact(args):
+    path, options = args
+    try:
+        return compact_recording(path, **options)
+    except Exception, e:
+        return {'recording': path, 'status': 'invalid',
+                'error': '%s: %s' % (e.__class__.__name__, e)}
+
+
+def compact_tree(root, processes=None, **options):
+    """Compact every recording under root with a pool of ``processes``
+    worker processes (one per CPU by default)
+
+    The options are those of :func:`compact_recording`. Returns the
+    list of results, in the order of the recording paths.
+
+    """
+    recordings = find_recordings(root)
+    if not recordings:
+        return []
+    args = [(path, options) for path in recordings]
+    if processes == 1:
+        return map(_compact, args)
+    pool = multiprocessing.Pool(processes)
+    try:
+        return pool.map(_compact, args, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def summarize(results, seconds):
+    """Return a one line summary of compaction results"""
+    compacted = [result for result in results
+                 if result['status'] == 'compacted']
+    saved = sum(result['bytes_before'] - result['bytes_after']
+                for result in compacted)
+    return ('%s recordings: %s compacted, %s skipped, %s invalid; '
+            '%s bytes saved in %.2fs' % (
+                len(results), len(compacted),
+                sum(1 for result in results if result['status'] == 'skipped'),
+                sum(1 for result in results if result['status'] == 'invalid'),
+                saved, seconds))
@@ -0,0 +1,176 @@
+"""Serve a dalton recording over HTTP
+
+The replay server answers requests from a recording with a
+:class:`dalton.Player`, so that other processes (and programs that
+don't use httplib) can play back a recording by pointing at a local
+address.
+
+The stand-in server answers with generated content, as a local target
+for tests and benchmarks.
+
+"""
+import BaseHTTPServer
+import SocketServer
+import threading
+
+import dalton
+
+# Headers that depend on how the response is sent rather than what was
+# recorded
+hop_headers = frozenset(['connection', 'content-length', 'keep-alive',
+                         'transfer-encoding'])
+
+
+class ReplayHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answers each request with the next recorded response
+
+    Connections are kept alive, and the handler instance is used as the
+    connection identity for the player. A connection is closed after a
+    response that closed it when recorded.
+
+    """
+    protocol_version = 'HTTP/1.1'
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def replay(self):
+        length = int(self.headers.getheader('content-length') or 0)
+        body = self.rfile.read(length) if length else None
+        headers = dict(self.headers.items())
+        player = self.server.player
+        try:
+            player.request(self.command, self.path, body, headers,
+                           connection=self)
+            response = player.getresponse(connection=self)
+        except Exception, e:
+            self.send_error(500, 'Playback failed: %s' % e)
+            return
+
+        content = response.read()
+        response.close()
+        self.send_status(response.status, response.reason)
+        for name, value in response.getheaders():
+            if name.lower() not in hop_headers:
+                self.send_header(name, value)
+        self.send_header('Content-Length', str(len(content)))
+        if not player.connection_open(self):
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(content)
+
+    def send_status(self, code, message):
+        """Send the status line without the ``Server`` and ``Date``
+        headers :meth:`send_response` adds, as the recorded headers are
+        sent instead"""
+        self.log_request(code)
+        self.wfile.write('%s %d %s\r\n' % (self.protocol_version, code,
+                                            message))
+
+    do_GET = do_POST = do_PUT = do_DELETE = do_HEAD = do_PATCH = \
+        do_OPTIONS = replay
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(
+                self, format, *args)
+
+
+class ReplayServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """A threaded HTTP server playing back a recording
+
+    Every connection is handled by its own thread, so many concurrent
+    keep-alive connections can share the player.
+
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, server_address, player, verbose=False):
+        BaseHTTPServer.HTTPServer.__init__(self, server_address,
+                                           ReplayHandler)
+        self.player = player
+        self.verbose = verbose
+
+
+def create_server(recording, host='127.0.0.1', port=8000, match='index',
+                  cursor='shared', match_headers=(), verbose=False,
+                  latency_scale=0):
+    """Create a :class:`ReplayServer` for the recording
+
+    The recording is anything :class:`dalton.Player` can load. As
+    clients connect to the server rather than the recorded host,
+    requests are matched without the host.
+
+    """
+    player = dalton.Player(recording, use_global=True, match=match,
+                           match_headers=match_headers, cursor=cursor,
+                           match_host=False, latency_scale=latency_scale)
+    return ReplayServer((host, port), player, verbose=verbose)
+
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves generated responses
+
+    - ``GET /size/N`` returns N bytes
+    - ``GET /chunked`` returns a chunked response
+    - ``GET /close`` returns a short text and closes the connection
+    - ``POST`` echoes the request body
+    - any other ``GET`` returns a short text naming the path
+
+    """
+    protocol_version = 'HTTP/1.1'
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        if self.path == '/chunked':
+            self.send_response(200)
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for chunk in ['first ', 'second ', 'third']:
+                self.wfile.write('%x\r\n%s\r\n' % (len(chunk), chunk))
+            self.wfile.write('0\r\n\r\n')
+            return
+        if self.path == '/close':
+            self._send_body('closing', close=True)
+            return
+        if self.path.startswith('/size/'):
+            body = 'x' * int(self.path.split('/')[-1])
+        else:
+            body = 'hello from %s' % self.path
+        self._send_body(body)
+
+    def do_POST(self):
+        length = int(self.headers.getheader('content-length') or 0)
+        self._send_body('posted ' + self.rfile.read(length))
+
+    def _send_body(self, body, close=False):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        if close:
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, server_address=('127.0.0.1', 0)):
+        BaseHTTPServer.HTTPServer.__init__(self, server_address,
+                                           StandInHandler)
+
+
+def start_in_thread(server, poll_interval=0.05):
+    """Run the server from a daemon thread, returning its address"""
+    thread = threading.Thread(target=server.serve_forever,
+                              args=(poll_interval,))
+    thread.daemon = True
+    thread.start()
+    return server.server_address
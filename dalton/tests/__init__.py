@@ -1,11 +1,29 @@
 import os
+import shutil
+import StringIO
+import sys
+import tempfile
+import threading
+import time
 import unittest
 import dalton
 import urllib
+from dalton.server import StandInServer, start_in_thread
 dalton.inject()
 
 here = os.path.abspath(os.path.dirname(__file__))
 
+
+_local_server = []
+
+def local_server():
+    """Return the (host, port) of a local server started on demand"""
+    if not _local_server:
+        server = StandInServer()
+        start_in_thread(server)
+        _local_server.append(server)
+    return _local_server[0].server_address
+
 class TestInject(unittest.TestCase):
     def _makeHttp(self, host):
         from httplib import HTTPConnection
@@ -26,6 +44,103 @@ class TestInject(unittest.TestCase):
         resp = h.getresponse()
         body = resp.read()
 
+    def testPatchedOnlyWhenActive(self):
+        """Test that httplib is only patched while something is active."""
+        from httplib import HTTPConnection
+        h = self._makeHttp('www.google.com')
+        assert HTTPConnection.request.im_func is not dalton._request
+        untouched = dict(HTTPConnection.__dict__)
+        recorder = dalton.Recorder(caller=h)
+        player = dalton.Player(caller=h, playback_dir=os.path.join(
+            here, 'test_recordings', 'google_play_test'))
+        with recorder.recording():
+            assert HTTPConnection.request.im_func is dalton._request
+            with player.playing():
+                assert HTTPConnection.request.im_func is dalton._request
+            assert HTTPConnection.request.im_func is dalton._request
+        assert HTTPConnection.request.im_func is not dalton._request
+        assert HTTPConnection.getresponse.im_func is not dalton._getresponse
+        assert dict(HTTPConnection.__dict__) == untouched
+
+    def testUninject(self):
+        """Test that nothing is patched after uninject()."""
+        from httplib import HTTPConnection
+        h = self._makeHttp('www.google.com')
+        recorder = dalton.Recorder(caller=h)
+        try:
+            with recorder.recording():
+                dalton.uninject()
+                assert HTTPConnection.request.im_func is not dalton._request
+            with recorder.recording():
+                assert HTTPConnection.request.im_func is not dalton._request
+        finally:
+            dalton.inject()
+        with recorder.recording():
+            assert HTTPConnection.request.im_func is dalton._request
+
+
+class TestIntercept(unittest.TestCase):
+    def _makeHttp(self, host):
+        from httplib import HTTPConnection
+        return HTTPConnection(host)
+
+    def testUnregistered(self):
+        h = self._makeHttp('www.google.com')
+        assert dalton._intercept(h) == {'mode': 'normal'}
+
+    def testConnectionInstance(self):
+        h = self._makeHttp('www.google.com')
+        other = self._makeHttp('www.google.com')
+        recorder = dalton.Recorder(caller=h)
+        with recorder.recording():
+            assert dalton._intercept(h)['recorder'] is recorder
+            assert 'recorder' not in dalton._intercept(other)
+        assert 'recorder' not in dalton._intercept(h)
+
+    def testConnectionClass(self):
+        from httplib import HTTPConnection, HTTPSConnection
+        h = self._makeHttp('www.google.com')
+        hs = HTTPSConnection('www.google.com')
+        recorder = dalton.Recorder(caller=HTTPConnection)
+        with recorder.recording():
+            assert dalton._intercept(h)['recorder'] is recorder
+            assert dalton._intercept(hs)['recorder'] is recorder
+
+    def testInstanceBeforeClass(self):
+        from httplib import HTTPConnection
+        h = self._makeHttp('www.google.com')
+        class_recorder = dalton.Recorder(caller=HTTPConnection)
+        recorder = dalton.Recorder(caller=h)
+        with class_recorder.recording():
+            with recorder.recording():
+                assert dalton._intercept(h)['recorder'] is recorder
+            assert dalton._intercept(h)['recorder'] is class_recorder
+
+    def testGlobalScopes(self):
+        h = self._makeHttp('www.google.com')
+        outer = dalton.Recorder(use_global=True)
+        inner = dalton.Recorder(use_global=True)
+        with outer.recording():
+            with inner.recording():
+                assert dalton._intercept(h)['recorder'] is inner
+            assert dalton._intercept(h)['recorder'] is outer
+        assert 'recorder' not in dalton._intercept(h)
+
+    def testWalkStack(self):
+        h = self._makeHttp('www.google.com')
+        class Browser(object):
+            def fetch(self):
+                return dalton._intercept(h)
+        browser = Browser()
+        recorder = dalton.Recorder(caller=browser, walk_stack=True)
+        with recorder.recording():
+            assert browser.fetch()['recorder'] is recorder
+            assert 'recorder' not in dalton._intercept(h)
+
+    def testNonConnectionCaller(self):
+        self.assertRaises(Exception, dalton.Recorder, caller=object())
+
+
 class TestRecorder(unittest.TestCase):
     def _makeHttp(self, host):
         from httplib import HTTPConnection
@@ -70,6 +185,1617 @@ class TestRecorder(unittest.TestCase):
         recorder.save(test_dir)
 
 
+class TestStreamingRecorder(unittest.TestCase):
+    def setUp(self):
+        self.host, self.port = local_server()
+        self.output_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def _makeHttp(self):
+        from httplib import HTTPConnection
+        return HTTPConnection(self.host, self.port)
+
+    def testChunkedPreserved(self):
+        h = self._makeHttp()
+        recorder = dalton.Recorder(caller=h, streaming=True,
+                                   spool_threshold=4)
+        with recorder.recording():
+            h.request('GET', '/chunked')
+            resp = h.getresponse()
+            assert resp.chunked
+            body = resp.read(3) + resp.read()
+        assert body == 'first second third'
+        step = recorder._interaction[0]
+        assert step.response_body._rolled
+        step.response_body.seek(0)
+        assert step.response_body.read() == body
+
+    def testSaveAndPlay(self):
+        h = self._makeHttp()
+        recorder = dalton.Recorder(caller=h, streaming=True)
+        with recorder.recording():
+            h.request('GET', '/size/5000')
+            resp = h.getresponse()
+            body = resp.read()
+            h.request('GET', '/size/0')
+            empty = h.getresponse().read()
+        test_dir = os.path.join(self.output_dir, 'streaming_test')
+        recorder.save(test_dir)
+        with open(os.path.join(test_dir, 'step_0_response.txt')) as f:
+            assert f.read() == body
+
+        player = dalton.Player(caller=h, playback_dir=test_dir)
+        with player.playing():
+            h.request('GET', '/size/5000')
+            assert h.getresponse().read() == 'x' * 5000
+            h.request('GET', '/size/0')
+            assert h.getresponse().read() == ''
+
+    def testPartlyRead(self):
+        h = self._makeHttp()
+        recorder = dalton.Recorder(caller=h, streaming=True)
+        with recorder.recording():
+            h.request('GET', '/size/5000')
+            assert h.getresponse().read(100) == 'x' * 100
+        test_dir = os.path.join(self.output_dir, 'partly_read')
+        recorder.save(test_dir)
+        with open(os.path.join(test_dir, 'step_0_response.txt')) as f:
+            assert f.read() == 'x' * 5000
+
+        recorder = dalton.Recorder(caller=h, streaming=True)
+        with recorder.recording():
+            h.request('GET', '/size/5000')
+            resp = h.getresponse()
+            resp.read(100)
+            resp.close()
+        assert not recorder._tees[0][1].drain()
+
+
+class TestLowLevel(unittest.TestCase):
+    def setUp(self):
+        self.host, self.port = local_server()
+        self.output_dir = tempfile.mkdtemp()
+        self.recording = os.path.join(self.output_dir, 'recording')
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def _makeHttp(self):
+        from httplib import HTTPConnection
+        return HTTPConnection(self.host, self.port)
+
+    def _post(self, h, chunks, length=8):
+        h.putrequest('POST', '/form')
+        h.putheader('Content-Length', str(length))
+        h.putheader('X-Test', 'yes')
+        h.endheaders()
+        for chunk in chunks:
+            h.send(chunk)
+        return h.getresponse().read()
+
+    def testRecordAndPlay(self):
+        h = self._makeHttp()
+        recorder = dalton.Recorder(caller=h)
+        with recorder.recording():
+            assert self._post(h, ['q=', 'dalton']) == 'posted q=dalton'
+            h.putrequest('GET', '/a')
+            h.endheaders()
+            assert h.getresponse().read() == 'hello from /a'
+        step = recorder._interaction[0]
+        assert step.request_method == 'POST'
+        assert step.request_headers == {'Content-Length': '8',
+                                        'X-Test': 'yes'}
+        step.request_body.seek(0)
+        assert step.request_body.read() == 'q=dalton'
+        assert recorder._interaction[1].request_body is None
+        recorder.save(self.recording)
+
+        player = dalton.Player(self.recording, caller=h, match='index')
+        with player.playing():
+            assert self._post(h, [StringIO.StringIO('q=dalton')]) == \
+                'posted q=dalton'
+            self.assertRaises(Exception, self._post, h, ['q=other'], 7)
+            h.request('GET', '/a')
+            assert h.getresponse().read() == 'hello from /a'
+
+    def testStreamedBodies(self):
+        h = self._makeHttp()
+        upload = tempfile.TemporaryFile()
+        upload.write('q=' + 'x' * 100000)
+        upload.seek(0)
+        chunks = (c for c in ['q=', 'it', 'er'])
+        recorder = dalton.Recorder(caller=h, spool_threshold=1024)
+        with recorder.recording():
+            h.request('POST', '/form', body=upload)
+            assert h.getresponse().read() == 'posted q=' + 'x' * 100000
+            h.request('POST', '/form', body=chunks)
+            assert h.getresponse().read() == 'posted q=iter'
+        body = recorder._interaction[0].request_body
+        assert body._rolled
+        body.seek(0)
+        assert body.read() == 'q=' + 'x' * 100000
+        recorder.save(self.recording)
+
+        player = dalton.Player(self.recording, caller=h, match='index')
+        with player.playing():
+            h.request('POST', '/form', body=(c for c in ['q=iter']))
+            assert h.getresponse().read() == 'posted q=iter'
+            upload.seek(0)
+            h.request('POST', '/form', body=upload)
+            assert h.getresponse().read() == 'posted q=' + 'x' * 100000
+
+
+class TestBodyDigest(unittest.TestCase):
+    def setUp(self):
+        self.host, self.port = local_server()
+        self.output_dir = tempfile.mkdtemp()
+        self.recording = os.path.join(self.output_dir, 'recording')
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def _makeHttp(self):
+        from httplib import HTTPConnection
+        return HTTPConnection(self.host, self.port)
+
+    def _requests(self, h, upload):
+        h.request('POST', '/form', body='q=dalton')
+        assert h.getresponse().read() == 'posted q=dalton'
+        upload.seek(0)
+        h.request('POST', '/form', body=upload)
+        assert h.getresponse().read() == 'posted ' + 'u' * 100000
+        h.putrequest('POST', '/form')
+        h.putheader('Content-Length', '6')
+        h.endheaders()
+        h.send('lo')
+        h.send('wlvl')
+        assert h.getresponse().read() == 'posted lowlvl'
+
+    def testRecord(self):
+        import hashlib
+        h = self._makeHttp()
+        upload = tempfile.TemporaryFile()
+        upload.write('u' * 100000)
+        recorder = dalton.Recorder(caller=h, request_bodies='digest',
+                                   digest_prefix=4)
+        with recorder.recording():
+            self._requests(h, upload)
+        bodies = [step.request_body for step in recorder._interaction]
+        assert bodies == [
+            dalton.BodyDigest(hashlib.sha1('q=dalton').hexdigest(), 8),
+            dalton.BodyDigest(hashlib.sha1('u' * 100000).hexdigest(), 100000),
+            dalton.BodyDigest(hashlib.sha1('lowlvl').hexdigest(), 6)]
+        assert [body.prefix for body in bodies] == ['q=da', 'uuuu', 'lowl']
+
+        recorder.save(self.recording)
+        assert not [name for name in os.listdir(self.recording)
+                    if 'request' in name]
+        archive = os.path.join(self.output_dir, 'recording.dalton')
+        recorder.save_archive(archive)
+        compact = os.path.join(self.output_dir, 'compact')
+        recorder.save(compact, compact=True)
+        for path in [self.recording, archive, compact]:
+            steps = dalton.iter_steps(dalton.load_recording(path))
+            assert [step.recorded_request['body'] for step in steps] == \
+                bodies
+
+        upload.seek(0)
+        for match in ['index', 'sequence']:
+            player = dalton.Player(self.recording, caller=h, match=match,
+                                   matcher=dalton.Matcher(body=True),
+                                   digest_bodies=True)
+            with player.playing():
+                self._requests(h, upload)
+                if match == 'index':
+                    self.assertRaises(Exception, h.request, 'POST', '/form',
+                                      body='q=other')
+
+        player = dalton.Player(self.recording, caller=h,
+                               matcher=dalton.Matcher(body=True))
+        with player.playing():
+            h.request('POST', '/form', body='q=other')
+            try:
+                h.getresponse()
+            except dalton.MismatchError, e:
+                assert e.differences[0][0] == 'body'
+            else:
+                self.fail('MismatchError not raised')
+
+
+def _crawl(args):
+    """Fetch a path from a pool worker"""
+    from httplib import HTTPConnection
+    host, port, path = args
+    h = HTTPConnection(host, port)
+    h.request('GET', path)
+    body = h.getresponse().read()
+    # Give the other workers a chance to take a path
+    time.sleep(0.05)
+    return body
+
+
+class TestJournal(unittest.TestCase):
+    def setUp(self):
+        self.host, self.port = local_server()
+        self.output_dir = tempfile.mkdtemp()
+        self.journal_dir = os.path.join(self.output_dir,
+            os.path.basename(self.output_dir))
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def _makeHttp(self):
+        from httplib import HTTPConnection
+        return HTTPConnection(self.host, self.port)
+
+    def _steps(self):
+        with open(os.path.join(self.journal_dir, '__init__.py')) as f:
+            return f.read().count('class StepNumber')
+
+    def testJournal(self):
+        h = self._makeHttp()
+        recorder = dalton.Recorder(caller=h, journal_dir=self.journal_dir)
+        with recorder.recording():
+            h.request('GET', '/a')
+            h.getresponse().read()
+            assert self._steps() == 1
+            h.request('POST', '/form', body='q=dalton')
+            h.getresponse().read()
+            assert self._steps() == 2
+        assert recorder._interaction == []
+        assert os.path.exists(os.path.join(self.journal_dir,
+                                           'step_1_request.txt'))
+
+        # Playable before being saved
+        player = dalton.Player(caller=h, playback_dir=self.journal_dir)
+        with player.playing():
+            h.request('GET', '/a')
+            assert h.getresponse().read() == 'hello from /a'
+            h.request('POST', '/form', body='q=dalton')
+            assert h.getresponse().read() == 'posted q=dalton'
+            self.assertRaises(Exception, h.request, 'GET', '/a')
+
+        recorder.save()
+        with open(os.path.join(self.journal_dir, '__init__.py')) as f:
+            assert f.read().endswith('StepNumber2 = None\n')
+
+    def testStreamingJournal(self):
+        h = self._makeHttp()
+        recorder = dalton.Recorder(caller=h, journal_dir=self.journal_dir,
+                                   streaming=True)
+        with recorder.recording():
+            h.request('GET', '/chunked')
+            resp = h.getresponse()
+            assert self._steps() == 1
+            body = resp.read(5) + resp.read()
+        recorder.save(self.journal_dir)
+        with open(os.path.join(self.journal_dir, 'step_0_response.txt')) as f:
+            assert f.read() == body
+
+    def testResume(self):
+        h = self._makeHttp()
+        for path in ['/a', '/b']:
+            recorder = dalton.Recorder(caller=h,
+                                       journal_dir=self.journal_dir)
+            with recorder.recording():
+                h.request('GET', path)
+                h.getresponse().read()
+        archive = os.path.join(self.output_dir, 'recording.dalton')
+        dalton.convert_recording(self.journal_dir, archive)
+        steps = dalton.RecordingArchive(archive).load()
+        assert len(steps) == 2
+        assert steps.StepNumber1.recorded_request['url'] == '/b'
+
+    def testPerProcess(self):
+        import multiprocessing
+        recorder = dalton.Recorder(use_global=True,
+                                   journal_dir=self.journal_dir,
+                                   per_process=True)
+        paths = ['/p%s' % i for i in range(6)]
+        with recorder.recording():
+            pool = multiprocessing.Pool(2)
+            try:
+                bodies = pool.map(_crawl, [(self.host, self.port, path)
+                                           for path in paths], chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+            assert bodies == ['hello from %s' % path for path in paths]
+            _crawl((self.host, self.port, '/parent'))
+        workers = [name for name in os.listdir(self.journal_dir)
+                   if name.startswith('worker_')]
+        assert 'worker_%s' % os.getpid() in workers
+        assert len(workers) == 3
+
+        recorder.save()
+        steps = list(dalton.iter_steps(
+            dalton.load_recording(self.journal_dir)))
+        assert len(steps) == 7
+        assert sorted(step.recorded_request['url'] for step in steps) == \
+            sorted(paths + ['/parent'])
+        started = [step.recorded_timing['started'] for step in steps]
+        assert started == sorted(started)
+        assert steps[-1].recorded_connection['worker'] == \
+            'worker_%s' % os.getpid()
+        assert set(step.recorded_connection['worker']
+                   for step in steps) == set(workers)
+
+        player = dalton.Player(self.journal_dir, use_global=True,
+                               match='index')
+        with player.playing():
+            assert _crawl((self.host, self.port, '/p3')) == 'hello from /p3'
+
+        dalton.merge_journals(self.journal_dir, remove_journals=True)
+        assert not [name for name in os.listdir(self.journal_dir)
+                    if name.startswith('worker_')]
+        self.assertRaises(Exception, dalton.Recorder, use_global=True,
+                          per_process=True)
+
+    def testPerProcessThreads(self):
+        recorder = dalton.Recorder(use_global=True,
+                                   journal_dir=self.journal_dir,
+                                   per_process=True)
+        start = threading.Event()
+        errors = []
+        def fetch(i):
+            try:
+                start.wait()
+                _crawl((self.host, self.port, '/t%s' % i))
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target=fetch, args=(i,))
+                   for i in range(16)]
+        with recorder.recording():
+            for thread in threads:
+                thread.start()
+            start.set()
+            for thread in threads:
+                thread.join()
+        assert not errors, errors
+        recorder.save()
+        steps = list(dalton.iter_steps(
+            dalton.load_recording(self.journal_dir)))
+        assert len(steps) == 16
+
+
+class TestRingRecorder(unittest.TestCase):
+    def setUp(self):
+        self.host, self.port = local_server()
+        self.output_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def _makeHttp(self):
+        from httplib import HTTPConnection
+        return HTTPConnection(self.host, self.port)
+
+    def _fetch(self, h, path):
+        h.request('GET', path)
+        return h.getresponse().read()
+
+    def testBounded(self):
+        h = self._makeHttp()
+        recorder = dalton.RingRecorder(caller=h, max_steps=3)
+        with recorder.recording():
+            for i in range(10):
+                assert self._fetch(h, '/%s' % i) == 'hello from /%s' % i
+        assert [step.request_url for step in recorder._interaction] == \
+            ['/7', '/8', '/9']
+
+        recorder = dalton.RingRecorder(caller=h, max_bytes=250,
+                                       max_body_size=100)
+        with recorder.recording():
+            assert len(self._fetch(h, '/size/1000')) == 1000
+            for i in range(3):
+                self._fetch(h, '/size/50')
+        assert [step.request_url for step in recorder._interaction] == \
+            ['/size/50'] * 3
+        assert recorder._bytes == 150
+
+    def testTruncate(self):
+        h = self._makeHttp()
+        recorder = dalton.RingRecorder(caller=h, max_body_size=10)
+        with recorder.recording():
+            assert len(self._fetch(h, '/size/100')) == 100
+        body = recorder._interaction[0].response_body
+        assert body == 'x' * 10 + dalton.truncated_marker % 100
+
+    def testStreamed(self):
+        h = self._makeHttp()
+        recorder = dalton.RingRecorder(caller=h, max_body_size=10)
+        with recorder.recording():
+            h.request('GET', '/chunked')
+            resp = h.getresponse()
+            assert resp.chunked
+            assert not recorder._interaction
+            chunked = resp.read(3) + resp.read()
+            h.request('GET', '/size/50000')
+            resp = h.getresponse()
+            assert resp.length == 50000
+            # Reading exactly the body, without an empty read after it
+            assert len(resp.read(50000)) == 50000
+            assert self._fetch(h, '/size/0') == ''
+        assert chunked == 'first second third'
+        assert [step.response_body for step in recorder._interaction] == [
+            'first seco' + dalton.truncated_marker % 18,
+            'x' * 10 + dalton.truncated_marker % 50000, '']
+        assert recorder._interaction[1].timing['total'] >= \
+            recorder._interaction[1].timing['ttfb']
+
+    def testFilter(self):
+        h = self._makeHttp()
+        recorder = dalton.RingRecorder(
+            caller=h, predicate=lambda step: '/keep' in step.request_url)
+        with recorder.recording():
+            assert self._fetch(h, '/drop') == 'hello from /drop'
+            assert self._fetch(h, '/keep') == 'hello from /keep'
+        assert [step.request_url for step in recorder._interaction] == \
+            ['/keep']
+
+        recorder = dalton.RingRecorder(caller=h, sample_rate=0.0)
+        with recorder.recording():
+            assert self._fetch(h, '/a') == 'hello from /a'
+        assert len(recorder._interaction) == 0
+
+    def testDump(self):
+        import signal
+        h = self._makeHttp()
+        recorder = dalton.RingRecorder(caller=h, max_steps=2)
+        with recorder.recording():
+            for path in ['/a', '/b', '/c']:
+                self._fetch(h, path)
+        recording = os.path.join(self.output_dir, 'dump')
+        recorder.dump(recording)
+        player = dalton.Player(caller=h, playback_dir=recording)
+        with player.playing():
+            assert self._fetch(h, '/b') == 'hello from /b'
+            assert self._fetch(h, '/c') == 'hello from /c'
+
+        dump_dir = os.path.join(self.output_dir, 'dumps')
+        previous = recorder.dump_on_signal(signal.SIGUSR1, dump_dir)
+        try:
+            os.kill(os.getpid(), signal.SIGUSR1)
+            recorder.dump_thread.join()
+        finally:
+            signal.signal(signal.SIGUSR1, previous)
+        dumps = os.listdir(dump_dir)
+        assert len(dumps) == 1
+        assert len(list(dalton.iter_steps(dalton.load_recording(
+            os.path.join(dump_dir, dumps[0]))))) == 2
+
+
+class TestCompressedRecording(unittest.TestCase):
+    def setUp(self):
+        self.host, self.port = local_server()
+        self.output_dir = tempfile.mkdtemp()
+        self.test_dir = os.path.join(self.output_dir,
+            os.path.basename(self.output_dir))
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def testRecordAndPlay(self):
+        from httplib import HTTPConnection
+        h = HTTPConnection(self.host, self.port)
+        recorder = dalton.Recorder(caller=h, compression='gzip',
+                                   compress_threshold=100)
+        with recorder.recording():
+            h.request('GET', '/size/50000')
+            h.getresponse().read()
+            h.request('GET', '/a')
+            h.getresponse().read()
+        recorder.save(self.test_dir)
+        assert sorted(os.listdir(self.test_dir)) == [
+            '__init__.py', 'step_0_response.txt.gz', 'step_1_response.txt']
+
+        player = dalton.Player(caller=h, playback_dir=self.test_dir)
+        with player.playing():
+            h.request('GET', '/size/50000')
+            resp = h.getresponse()
+            assert resp.read(10) == 'x' * 10
+            assert resp.read() == 'x' * 49990
+            h.request('GET', '/a')
+            assert h.getresponse().read() == 'hello from /a'
+
+        player = dalton.Player(caller=h, playback_dir=self.test_dir)
+        with player.playing():
+            h.request('GET', '/size/50000')
+            resp = h.getresponse()
+            body = resp._content
+            assert resp.read(10) == 'x' * 10
+            resp.close()
+            assert body._file.closed
+            assert resp.read() == ''
+
+
+class TestBlobStore(unittest.TestCase):
+    def setUp(self):
+        self.host, self.port = local_server()
+        self.output_dir = tempfile.mkdtemp()
+        self.store = dalton.BlobStore(os.path.join(self.output_dir, 'blobs'))
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def _makeHttp(self):
+        from httplib import HTTPConnection
+        return HTTPConnection(self.host, self.port)
+
+    def _record(self, name):
+        h = self._makeHttp()
+        recorder = dalton.Recorder(caller=h, blob_store=self.store)
+        with recorder.recording():
+            for i in range(2):
+                h.request('POST', '/form', body='q=dalton')
+                h.getresponse().read()
+        test_dir = os.path.join(self.output_dir, name)
+        recorder.save(test_dir)
+        return test_dir
+
+    def _blobs(self):
+        return sorted(name for prefix in os.listdir(self.store.directory)
+                      for name in os.listdir(
+                          os.path.join(self.store.directory, prefix))
+                      if not name.endswith('.refs'))
+
+    def testShared(self):
+        first = self._record('blob_first')
+        second = self._record('blob_second')
+        assert os.listdir(first) == ['__init__.py']
+        assert len(self._blobs()) == 2
+        digest = dalton.body_digest('posted q=dalton')
+        assert self.store.refs(digest) == 4
+
+        h = self._makeHttp()
+        player = dalton.Player(caller=h, playback_dir=second)
+        with player.playing():
+            h.request('POST', '/form', body='q=dalton')
+            assert h.getresponse().read() == 'posted q=dalton'
+
+        self.store.release_recording(first)
+        assert self.store.refs(digest) == 2
+        assert self.store.collect() == (0, 0)
+        self.store.release_recording(second)
+        assert self.store.collect() == (2, len('q=dalton') +
+                                        len('posted q=dalton'))
+        assert self._blobs() == []
+
+    def testSaveOver(self):
+        self._record('blob_again')
+        test_dir = self._record('blob_again')
+        digest = dalton.body_digest('posted q=dalton')
+        assert self.store.refs(digest) == 2
+        self.store.release_recording(test_dir)
+        assert self.store.collect()[0] == 2
+
+    def testAddFile(self):
+        fw = dalton.FileWrapper('step_0_response.txt',
+                                os.path.join(here, 'test_files'))
+        blob = self.store.add(fw)
+        assert blob.load() == fw.load()
+        assert blob.digest == dalton.body_digest(fw)
+        assert self.store.add(fw.load()).path == blob.path
+        assert self.store.refs(blob.digest) == 2
+
+
+class TestArchive(unittest.TestCase):
+    def setUp(self):
+        self.host, self.port = local_server()
+        self.output_dir = tempfile.mkdtemp()
+        self.archive = os.path.join(self.output_dir, 'recording.dalton')
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def _makeHttp(self):
+        from httplib import HTTPConnection
+        return HTTPConnection(self.host, self.port)
+
+    def _record(self, h):
+        recorder = dalton.Recorder(caller=h)
+        with recorder.recording():
+            h.request('GET', '/chunked')
+            h.getresponse().read()
+            h.request('POST', '/form', body='q=dalton')
+            h.getresponse().read()
+        return recorder
+
+    def testSaveAndPlay(self):
+        h = self._makeHttp()
+        self._record(h).save_archive(self.archive)
+        assert len(os.listdir(self.output_dir)) == 1
+
+        archive = dalton.RecordingArchive(self.archive).load()
+        assert len(archive) == 2
+        assert archive.StepNumber0.recorded_request['host'] == self.host
+        assert archive.StepNumber1.recorded_request['body'].load() == \
+            'q=dalton'
+
+        player = dalton.Player(caller=h, playback_dir=self.archive)
+        with player.playing():
+            h.request('GET', '/chunked')
+            resp = h.getresponse()
+            assert resp.read() == 'first second third'
+            assert resp.getheader('transfer-encoding') == 'chunked'
+            h.request('POST', '/form', body='q=dalton')
+            assert h.getresponse().read() == 'posted q=dalton'
+            self.assertRaises(Exception, h.request, 'GET', '/')
+
+    def testAppend(self):
+        h = self._makeHttp()
+        recorder = self._record(h)
+        recorder.save_archive(self.archive)
+        dalton.RecordingArchive(self.archive).append(recorder._interaction)
+        archive = dalton.RecordingArchive(self.archive).load()
+        assert len(archive) == 4
+        assert archive.StepNumber3.recorded_response['body'].load() == \
+            'posted q=dalton'
+        assert archive.StepNumber3.next_step == 'None'
+
+    def testInterruptedAppend(self):
+        class Failing(object):
+            def seek(self, offset):
+                pass
+
+            def read(self, amt=-1):
+                raise IOError('gone')
+        h = self._makeHttp()
+        recorder = self._record(h)
+        recorder.save_archive(self.archive)
+        step = recorder._interaction[1]
+        step.response_body = Failing()
+        self.assertRaises(IOError, dalton.RecordingArchive(
+            self.archive).append, [step])
+        archive = dalton.RecordingArchive(self.archive).load()
+        assert len(archive) == 2
+        assert archive.StepNumber1.recorded_response['body'].load() == \
+            'posted q=dalton'
+
+    def testConvert(self):
+        test_dir = os.path.join(here, 'test_recordings', 'google_play_test')
+        dalton.convert_recording(test_dir, self.archive)
+        h = self._makeHttp()
+        player = dalton.Player(caller=h, playback_dir=self.archive)
+        with player.playing():
+            h.request('GET', '/')
+            resp = h.getresponse()
+            body = resp.read()
+        assert '<title>GoogleFoo</title>' in body
+        assert resp.getheader('x-xss-protection') == '1; mode=block'
+
+
+class TestStepTable(unittest.TestCase):
+    def setUp(self):
+        self.host, self.port = local_server()
+        self.output_dir = tempfile.mkdtemp()
+        self.recording = os.path.join(self.output_dir, 'compact')
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def _makeHttp(self):
+        from httplib import HTTPConnection
+        return HTTPConnection(self.host, self.port)
+
+    def _record(self, h):
+        recorder = dalton.Recorder(caller=h)
+        with recorder.recording():
+            h.request('GET', '/chunked')
+            h.getresponse().read()
+            h.request('POST', '/form', body='q=dalton')
+            h.getresponse().read()
+        recorder.save(self.recording, compact=True)
+
+    def testSaveAndPlay(self):
+        h = self._makeHttp()
+        self._record(h)
+        with open(os.path.join(self.recording, 'steps.jsonl')) as f:
+            assert len(f.readlines()) == 2
+
+        recording = dalton.load_recording(self.recording)
+        assert len(recording.steps) == 2
+        step = recording.steps.step(1)
+        assert step.recorded_request['body'].load() == 'q=dalton'
+        assert step.next_step == 'None'
+        assert len(list(dalton.iter_steps(recording))) == 2
+
+        player = dalton.Player(caller=h, playback_dir=self.recording)
+        with player.playing():
+            h.request('GET', '/chunked')
+            resp = h.getresponse()
+            assert resp.read() == 'first second third'
+            assert resp.getheader('transfer-encoding') == 'chunked'
+            h.request('POST', '/form', body='q=dalton')
+            assert h.getresponse().read() == 'posted q=dalton'
+            self.assertRaises(Exception, h.request, 'GET', '/')
+
+    def testNotRetained(self):
+        h = self._makeHttp()
+        self._record(h)
+        templates = len(dalton._response_templates)
+        for i in range(20):
+            player = dalton.Player(caller=h, playback_dir=self.recording)
+            with player.playing():
+                h.request('GET', '/chunked')
+                h.getresponse().read()
+                h.request('POST', '/form', body='q=dalton')
+                h.getresponse().read()
+            assert not player._request_matcher._recorded_keys
+        assert not dalton.default_matcher._recorded_keys
+        assert len(dalton._response_templates) == templates
+
+    def testCustomStep(self):
+        h = self._makeHttp()
+        self._record(h)
+        with open(os.path.join(self.recording, '__init__.py'), 'a') as f:
+            f.write('\n'.join([
+                '',
+                'class StepNumber1(steps.step(1)):',
+                '    def handle_request(self, request):',
+                '        request.body = "q=dalton"',
+                '        return super(StepNumber1, self).handle_request(',
+                '            request)',
+                '']))
+        player = dalton.Player(caller=h, playback_dir=self.recording)
+        with player.playing():
+            h.request('GET', '/chunked')
+            h.getresponse().read()
+            h.request('POST', '/form', body='q=other')
+            assert h.getresponse().read() == 'posted q=dalton'
+
+    def testConvert(self):
+        h = self._makeHttp()
+        self._record(h)
+        archive = os.path.join(self.output_dir, 'recording.dalton')
+        dalton.convert_recording(self.recording, archive)
+        assert len(dalton.RecordingArchive(archive).load()) == 2
+
+    def testJournal(self):
+        recorder = dalton.Recorder(caller=self._makeHttp(),
+                                   journal_dir=self.recording)
+        self.assertRaises(Exception, recorder.save, compact=True)
+
+
+class TestTiming(unittest.TestCase):
+    def setUp(self):
+        self.host, self.port = local_server()
+        self.output_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def _makeHttp(self):
+        from httplib import HTTPConnection
+        return HTTPConnection(self.host, self.port)
+
+    def testRecord(self):
+        for streaming in [False, True]:
+            h = self._makeHttp()
+            recorder = dalton.Recorder(caller=h, streaming=streaming)
+            with recorder.recording():
+                h.request('GET', '/size/1000')
+                h.getresponse().read()
+            timing = recorder._interaction[0].timing
+            assert 0 < timing['ttfb'] <= timing['total']
+            assert abs(timing['started'] - time.time()) < 60
+
+        recording = os.path.join(self.output_dir, 'recording')
+        archive = os.path.join(self.output_dir, 'recording.dalton')
+        compact = os.path.join(self.output_dir, 'compact')
+        recorder.save(recording)
+        recorder.save_archive(archive)
+        recorder.save(compact, compact=True)
+        for path in [recording, archive, compact]:
+            step = list(dalton.iter_steps(dalton.load_recording(path)))[0]
+            assert step.recorded_timing == timing
+
+    def _play(self, latency_scale):
+        step = dalton.InteractionStep(host=self.host)
+        step.request_method = 'GET'
+        step.request_url = '/'
+        step.response_status = 200
+        step.response_reason = 'OK'
+        step.response_version = 11
+        step.response_headers = []
+        step.response_body = 'x' * 100
+        step.timing = {'started': time.time(), 'ttfb': 0.2, 'total': 0.6}
+        recording = os.path.join(self.output_dir, 'slow')
+        dalton.save_recording([step], recording)
+
+        h = self._makeHttp()
+        player = dalton.Player(recording, caller=h,
+                               latency_scale=latency_scale)
+        with player.playing():
+            start = time.time()
+            h.request('GET', '/')
+            response = h.getresponse()
+            ttfb = time.time() - start
+            while response.read(10):
+                pass
+            return ttfb, time.time() - start
+
+    def testLatency(self):
+        ttfb, total = self._play(0)
+        assert total < 0.05
+        ttfb, total = self._play(0.5)
+        assert 0.1 <= ttfb < 0.2
+        assert 0.3 <= total < 0.45
+
+
+class TestInstrument(unittest.TestCase):
+    def setUp(self):
+        self.host, self.port = local_server()
+        self.output_dir = tempfile.mkdtemp()
+        self.metrics = dalton.Metrics()
+        self.previous = dalton.set_instrument(self.metrics)
+
+    def tearDown(self):
+        dalton.set_instrument(self.previous)
+        shutil.rmtree(self.output_dir)
+
+    def _makeHttp(self):
+        from httplib import HTTPConnection
+        return HTTPConnection(self.host, self.port)
+
+    def testRecordAndPlay(self):
+        h = self._makeHttp()
+        recorder = dalton.Recorder(caller=h)
+        with recorder.recording():
+            h.request('GET', '/size/1000')
+            assert len(h.getresponse().read()) == 1000
+            other = self._makeHttp()
+            other.request('GET', '/size/10')
+            other.getresponse().read()
+        recording = os.path.join(self.output_dir, 'recording')
+        recorder.save(recording)
+
+        matcher = dalton.Matcher(ignore_params=['ts'])
+        for i in range(2):
+            player = dalton.Player(recording, caller=h, match='index',
+                                   matcher=matcher)
+            with player.playing():
+                h.request('GET', '/size/1000')
+                response = h.getresponse()
+                while response.read(300):
+                    pass
+
+        snapshot = self.metrics.snapshot()
+        counters, timings = snapshot['counters'], snapshot['timings']
+        assert counters['intercept.record'] == 2
+        assert counters['intercept.passthrough'] == 2
+        assert counters['intercept.playback'] == 4
+        assert counters['recorded.bytes'] == 1000
+        assert counters['replayed.bytes'] == 2000
+        for name in ['intercept', 'record_response', 'save', 'getresponse',
+                     'step_lookup']:
+            assert timings[name]['count'] >= 1, name
+        assert timings['intercept']['count'] == 8
+        assert timings['body_load']['count'] == 2
+        assert timings['save']['mean'] == timings['save']['total']
+        assert self.metrics.hit_rate('recording') == 0.5
+        assert self.metrics.hit_rate('response_template') == 0.5
+        assert self.metrics.hit_rate('matcher') == 0.75
+        assert self.metrics.hit_rate('missing') is None
+
+        self.metrics.reset()
+        assert self.metrics.snapshot() == {'counters': {}, 'timings': {}}
+
+    def testDisabled(self):
+        import httplib
+        dalton.set_instrument(None)
+        h = self._makeHttp()
+        recorder = dalton.Recorder(caller=h)
+        intercept = lambda: httplib.HTTPConnection._intercept.im_func
+        with recorder.recording():
+            assert intercept() is dalton._intercept
+            h.request('GET', '/size/10')
+            h.getresponse().read()
+            dalton.set_instrument(self.metrics)
+            assert intercept() is dalton._timed_intercept
+            h.request('GET', '/size/10')
+            h.getresponse().read()
+        assert self.metrics.counters['intercept.record'] == 2
+        assert self.metrics.counters['recorded.bytes'] == 10
+
+
+class TestConnections(unittest.TestCase):
+    paths = ['/a', '/b', '/close', '/c']
+
+    def setUp(self):
+        self.host, self.port = local_server()
+        self.output_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def _makeHttp(self):
+        from httplib import HTTPConnection
+        return HTTPConnection(self.host, self.port)
+
+    def _requests(self, h, close=False):
+        for path in self.paths:
+            h.request('GET', path)
+            h.getresponse().read()
+            if close:
+                h.close()
+
+    def _record(self):
+        recorder = dalton.Recorder(use_global=True)
+        with recorder.recording():
+            self._requests(self._makeHttp())
+            self._requests(self._makeHttp())
+        return recorder
+
+    def testRecord(self):
+        recorder = self._record()
+        connections = [step.connection for step in recorder._interaction]
+        expected = [{'id': 0, 'reused': False, 'close': False},
+                    {'id': 0, 'reused': True, 'close': False},
+                    {'id': 0, 'reused': True, 'close': True},
+                    {'id': 0, 'reused': False, 'close': False}]
+        assert connections[:4] == expected
+        assert [c['id'] for c in connections[4:]] == [1] * 4
+
+        recording = os.path.join(self.output_dir, 'recording')
+        archive = os.path.join(self.output_dir, 'recording.dalton')
+        compact = os.path.join(self.output_dir, 'compact')
+        recorder.save(recording)
+        recorder.save_archive(archive)
+        recorder.save(compact, compact=True)
+        for path in [recording, archive, compact]:
+            steps = list(dalton.iter_steps(dalton.load_recording(path)))
+            assert [step.recorded_connection for step in steps] == \
+                connections
+
+    def testPlay(self):
+        recording = os.path.join(self.output_dir, 'recording')
+        self._record().save(recording)
+        for close, opened, extra in [(False, 4, 0), (True, 8, 4)]:
+            player = dalton.Player(recording, use_global=True)
+            with player.playing():
+                self._requests(self._makeHttp(), close)
+                self._requests(self._makeHttp(), close)
+            stats = player.connection_stats()
+            assert stats['requests'] == 8
+            assert stats['connections'] == opened
+            assert stats['reused'] == 8 - opened
+            assert stats['recorded_connections'] == 4
+            assert stats['extra_connections'] == extra
+
+    def testWillClose(self):
+        recording = os.path.join(self.output_dir, 'recording')
+        self._record().save(recording)
+        player = dalton.Player(recording, use_global=True)
+        with player.playing():
+            h = self._makeHttp()
+            for path in self.paths:
+                h.request('GET', path)
+                response = h.getresponse()
+                response.read()
+                assert response.will_close == (path == '/close')
+
+        response = {'status': 200, 'reason': 'OK', 'body': '',
+                    'version': 11, 'headers': []}
+        assert not dalton.create_response(response).will_close
+        response['headers'] = [('Connection', 'close')]
+        assert dalton.create_response(response).will_close
+        response.update(version=10, headers=[])
+        assert dalton.create_response(response).will_close
+        response['headers'] = [('Connection', 'keep-alive')]
+        assert not dalton.create_response(response).will_close
+
+    def testReplayServer(self):
+        from httplib import HTTPConnection
+        from dalton.server import create_server
+        recording = os.path.join(self.output_dir, 'recording')
+        self._record().save(recording)
+        server = create_server(recording, port=0)
+        try:
+            h = HTTPConnection(*start_in_thread(server))
+            for path in self.paths:
+                h.request('GET', path)
+                response = h.getresponse()
+                response.read()
+                assert response.will_close == (path == '/close')
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def testFailedRequests(self):
+        import gc
+        import socket
+        from httplib import HTTPConnection
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        recorder = dalton.RingRecorder(caller=HTTPConnection)
+        connections = []
+        with recorder.recording():
+            for i in range(10):
+                h = HTTPConnection('127.0.0.1', port)
+                connections.append(h)
+                self.assertRaises(socket.error, h.request, 'GET', '/')
+                h = HTTPConnection('127.0.0.1', port)
+                connections.append(h)
+                h.putrequest('GET', '/')
+                self.assertRaises(socket.error, h.endheaders)
+        assert len(recorder._pending) == 0
+        assert not recorder._interaction
+        # A connection dropped before getting its response is
+        # forgotten too
+        class Connection(object):
+            pass
+        connection = Connection()
+        recorder._record_request('localhost', 'GET', '/', None, {},
+                                 connection)
+        assert len(recorder._pending) == 1
+        del connection
+        gc.collect()
+        assert len(recorder._pending) == 0
+
+
+class TestIndexedPlayer(unittest.TestCase):
+    def setUp(self):
+        self.host, self.port = local_server()
+        self.output_dir = tempfile.mkdtemp()
+        self.archive = os.path.join(self.output_dir, 'recording.dalton')
+        h = self._makeHttp()
+        recorder = dalton.Recorder(caller=h)
+        with recorder.recording():
+            for path in ['/a', '/b', '/a']:
+                h.request('GET', path)
+                h.getresponse().read()
+            for value in ['1', '2']:
+                h.request('POST', '/form', body='q=dalton',
+                          headers={'X-Id': value})
+                h.getresponse().read()
+        recorder.save_archive(self.archive)
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def _makeHttp(self):
+        from httplib import HTTPConnection
+        return HTTPConnection(self.host, self.port)
+
+    def _fetch(self, h, path, **kwargs):
+        h.request('GET', path, **kwargs)
+        return h.getresponse().read()
+
+    def testOutOfOrder(self):
+        h = self._makeHttp()
+        player = dalton.Player(caller=h, playback_dir=self.archive,
+                               match='index')
+        with player.playing():
+            assert self._fetch(h, '/b') == 'hello from /b'
+            assert self._fetch(h, '/a') == 'hello from /a'
+            assert self._fetch(h, '/a') == 'hello from /a'
+            self.assertRaises(Exception, self._fetch, h, '/a')
+            self.assertRaises(Exception, self._fetch, h, '/missing')
+
+    def testHostAndBody(self):
+        from httplib import HTTPConnection
+        player = dalton.Player(use_global=True, playback_dir=self.archive,
+                               match='index')
+        with player.playing():
+            h = HTTPConnection('elsewhere.example.com')
+            self.assertRaises(Exception, self._fetch, h, '/a')
+            h = self._makeHttp()
+            self.assertRaises(Exception, h.request, 'POST', '/form',
+                              body='q=other')
+            h.request('POST', '/form', body='q=dalton')
+            assert h.getresponse().read() == 'posted q=dalton'
+            h.request('POST', '/form', body='q=dalton')
+            assert h.getresponse().read() == 'posted q=dalton'
+
+    def testMatchHeaders(self):
+        h = self._makeHttp()
+        player = dalton.Player(caller=h, playback_dir=self.archive,
+                               match='index', match_headers=['x-id'])
+        with player.playing():
+            h.request('POST', '/form', body='q=dalton', headers={'X-Id': '2'})
+            assert h.getresponse().read() == 'posted q=dalton'
+            h.request('POST', '/form', body='q=dalton', headers={'x-id': '1'})
+            assert h.getresponse().read() == 'posted q=dalton'
+            self.assertRaises(Exception, h.request, 'POST', '/form',
+                              body='q=dalton', headers={'X-Id': '1'})
+
+    def testFingerprint(self):
+        body = dalton.FileWrapper('step_0_response.txt',
+                                  os.path.join(here, 'test_files'))
+        key = dalton.request_fingerprint('GET', '/', body.load(),
+                                         {'Accept': 'text/html'}, ['accept'])
+        assert key == dalton.request_fingerprint(
+            'GET', '/', body, {'accept': 'text/html'}, ['accept'])
+
+
+class TestMatcher(unittest.TestCase):
+    def _request(self, method, url, body=None, headers=None):
+        req = dalton.Request()
+        req.method = method
+        req.url = url
+        req.body = body
+        req.headers = headers
+        return req
+
+    def _recorded(self, method, url, body=None, headers=None):
+        return {'method': method, 'url': url, 'body': body,
+                'headers': headers or {}}
+
+    def testDefault(self):
+        recorded = self._recorded('GET', '/a?x=1')
+        assert dalton.request_match(self._request('GET', '/a?x=1'), recorded)
+        try:
+            dalton.request_match(self._request('POST', '/a?x=2'), recorded)
+        except dalton.MismatchError, e:
+            assert e.differences == [('method', 'POST', 'GET'),
+                                     ('url', '/a?x=2', '/a?x=1')]
+            assert "url: '/a?x=2' != '/a?x=1'" in str(e)
+        else:
+            self.fail('MismatchError not raised')
+
+    def testCacheSize(self):
+        matcher = dalton.Matcher(cache_size=2)
+        recorded = [self._recorded('GET', '/%s' % i) for i in range(5)]
+        for i, recorded_request in enumerate(recorded):
+            assert matcher.recorded_key(recorded_request)[1] == '/%s' % i
+            assert len(matcher._recorded_keys) <= 2
+
+    def testIgnoreParams(self):
+        matcher = dalton.Matcher(ignore_params=['ts'])
+        recorded = self._recorded('GET', '/a?b=2&a=1&ts=100')
+        for url in ['/a?a=1&b=2', '/a?ts=200&a=1&b=2']:
+            assert dalton.request_match(self._request('GET', url), recorded,
+                                        matcher)
+        self.assertRaises(dalton.MismatchError, dalton.request_match,
+                          self._request('GET', '/a?a=2&b=2'), recorded,
+                          matcher)
+
+    def testHeaders(self):
+        matcher = dalton.Matcher(headers=['Accept'])
+        recorded = self._recorded('GET', '/', headers={'accept': 'text/html'})
+        req = self._request('GET', '/', headers={'ACCEPT': ' text/html'})
+        assert dalton.request_match(req, recorded, matcher)
+        req = self._request('GET', '/', headers={'Accept': 'text/plain'})
+        try:
+            dalton.request_match(req, recorded, matcher)
+        except dalton.MismatchError, e:
+            assert e.differences == [('header accept', 'text/plain',
+                                      'text/html')]
+        else:
+            self.fail('MismatchError not raised')
+
+    def testJsonBody(self):
+        matcher = dalton.Matcher(json_body=True)
+        recorded = self._recorded('POST', '/', '{"a": 1, "b": [1, 2]}')
+        req = self._request('POST', '/', '{"b":[1,2],"a":1}')
+        assert dalton.request_match(req, recorded, matcher)
+        req = self._request('POST', '/', StringIO.StringIO('{"a": 2}'))
+        self.assertRaises(dalton.MismatchError, dalton.request_match, req,
+                          recorded, matcher)
+        req = self._request('POST', '/', 'not json')
+        self.assertRaises(dalton.MismatchError, dalton.request_match, req,
+                          recorded, matcher)
+
+        # Digested bodies can't be compared as JSON
+        digest = dalton.BodyDigest.of('{"a": 1}')
+        self.assertRaises(Exception, matcher.key, 'POST', '/x', digest)
+        try:
+            dalton.request_match(self._request('POST', '/', digest),
+                                 recorded, matcher)
+        except dalton.MismatchError:
+            self.fail('Digested body reported as a mismatch')
+        except Exception, e:
+            assert 'digest' in str(e)
+        else:
+            self.fail('Exception not raised')
+        self.assertRaises(Exception, dalton.Player, use_global=True,
+                          playback_dir=os.path.join(
+                              here, 'test_recordings', 'google_play_test'),
+                          matcher=matcher, digest_bodies=True)
+
+    def testUrlTemplates(self):
+        matcher = dalton.Matcher(url_templates=['/users/{id}',
+                                                '/users/{id}/posts'])
+        recorded = self._recorded('GET', '/users/1/posts')
+        assert dalton.request_match(self._request('GET', '/users/2/posts'),
+                                    recorded, matcher)
+        self.assertRaises(dalton.MismatchError, dalton.request_match,
+                          self._request('GET', '/users/2'), recorded,
+                          matcher)
+        self.assertRaises(dalton.MismatchError, dalton.request_match,
+                          self._request('GET', '/users/2/posts?x=1'),
+                          recorded, matcher)
+
+    def testPlayer(self):
+        host, port = local_server()
+        output_dir = tempfile.mkdtemp()
+        try:
+            from httplib import HTTPConnection
+            h = HTTPConnection(host, port)
+            recorder = dalton.Recorder(caller=h)
+            with recorder.recording():
+                for path in ['/items/1?ts=1', '/items/2?ts=2']:
+                    h.request('GET', path)
+                    h.getresponse().read()
+            recorder.save(output_dir)
+
+            matcher = dalton.Matcher(ignore_params=['ts'])
+            for match in ['sequence', 'index']:
+                player = dalton.Player(output_dir, caller=h, match=match,
+                                       matcher=matcher)
+                with player.playing():
+                    h.request('GET', '/items/2?ts=3')
+                    if match == 'index':
+                        assert h.getresponse().read() == \
+                            'hello from /items/2?ts=2'
+                    else:
+                        self.assertRaises(dalton.MismatchError,
+                                          h.getresponse)
+
+            matcher = dalton.Matcher(url_templates=['/items/{id}'],
+                                     ignore_params=['ts'])
+            player = dalton.Player(output_dir, caller=h, matcher=matcher)
+            with player.playing():
+                h.request('GET', '/items/5?ts=3')
+                assert h.getresponse().read() == 'hello from /items/1?ts=1'
+        finally:
+            shutil.rmtree(output_dir)
+
+
+class TestConcurrency(unittest.TestCase):
+    threads = 32
+
+    def setUp(self):
+        self.host, self.port = local_server()
+        self.output_dir = tempfile.mkdtemp()
+        self.archive = os.path.join(self.output_dir, 'recording.dalton')
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def _makeHttp(self):
+        from httplib import HTTPConnection
+        return HTTPConnection(self.host, self.port)
+
+    def _run_threads(self, target, count):
+        errors = []
+        def run(number):
+            try:
+                target(number)
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target=run, args=(number,))
+                   for number in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert not errors, errors
+
+    def _fetch(self, h, path):
+        h.request('GET', path)
+        return h.getresponse().read()
+
+    def testRecordFromThreads(self):
+        recorder = dalton.Recorder(use_global=True)
+        def record(number):
+            h = self._makeHttp()
+            for step in range(4):
+                self._fetch(h, '/%s/%s' % (number, step))
+        with recorder.recording():
+            self._run_threads(record, 16)
+        assert len(recorder._interaction) == 64
+        for step in recorder._interaction:
+            assert step.response_body == 'hello from %s' % step.request_url
+
+    def testGlobalPlayerVisibleInThreads(self):
+        h = self._makeHttp()
+        recorder = dalton.Recorder(caller=h)
+        with recorder.recording():
+            self._fetch(h, '/a')
+        recorder.save_archive(self.archive)
+        player = dalton.Player(use_global=True, playback_dir=self.archive)
+        results = []
+        with player.playing():
+            self._run_threads(
+                lambda number: results.append(
+                    self._fetch(self._makeHttp(), '/a')), 1)
+        assert results == ['hello from /a']
+
+    def testPerConnectionCursors(self):
+        h = self._makeHttp()
+        paths = ['/a', '/b', '/c', '/a']
+        recorder = dalton.Recorder(caller=h)
+        with recorder.recording():
+            for path in paths:
+                self._fetch(h, path)
+        recorder.save_archive(self.archive)
+        player = dalton.Player(use_global=True, playback_dir=self.archive,
+                               cursor='connection')
+        def replay(number):
+            h = self._makeHttp()
+            for path in paths:
+                assert self._fetch(h, path) == 'hello from %s' % path
+            self.assertRaises(Exception, h.request, 'GET', '/a')
+        with player.playing():
+            self._run_threads(replay, self.threads)
+        import gc
+        gc.collect()
+        assert len(player._cursors) == 0
+
+    def testSharedIndex(self):
+        h = self._makeHttp()
+        recorder = dalton.Recorder(caller=h)
+        with recorder.recording():
+            for number in range(self.threads):
+                for step in range(3):
+                    self._fetch(h, '/%s' % number)
+        recorder.save_archive(self.archive)
+        player = dalton.Player(use_global=True, playback_dir=self.archive,
+                               match='index')
+        def replay(number):
+            h = self._makeHttp()
+            for step in range(3):
+                assert self._fetch(h, '/%s' % number) == \
+                    'hello from /%s' % number
+        with player.playing():
+            self._run_threads(replay, self.threads)
+            self.assertRaises(Exception, self._fetch, h, '/0')
+
+    def testSharedSequence(self):
+        h = self._makeHttp()
+        recorder = dalton.Recorder(caller=h)
+        with recorder.recording():
+            for number in range(self.threads * 2):
+                self._fetch(h, '/a')
+        recorder.save_archive(self.archive)
+        player = dalton.Player(use_global=True, playback_dir=self.archive)
+        def replay(number):
+            h = self._makeHttp()
+            for step in range(2):
+                assert self._fetch(h, '/a') == 'hello from /a'
+        with player.playing():
+            self._run_threads(replay, self.threads)
+            self.assertRaises(Exception, self._fetch, h, '/a')
+
+
+class TestReplayServer(unittest.TestCase):
+    paths = ['/a', '/chunked', '/b']
+
+    def setUp(self):
+        from httplib import HTTPConnection
+        host, port = local_server()
+        self.output_dir = tempfile.mkdtemp()
+        self.archive = os.path.join(self.output_dir, 'recording.dalton')
+        h = HTTPConnection(host, port)
+        recorder = dalton.Recorder(caller=h)
+        with recorder.recording():
+            for path in self.paths:
+                h.request('GET', path)
+                h.getresponse().read()
+        recorder.save_archive(self.archive)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.output_dir)
+
+    def _serve(self, **kwargs):
+        from dalton.server import create_server
+        self.server = create_server(self.archive, port=0, **kwargs)
+        return start_in_thread(self.server)
+
+    def testIndexed(self):
+        from httplib import HTTPConnection
+        h = HTTPConnection(*self._serve())
+        h.request('GET', '/b')
+        resp = h.getresponse()
+        assert resp.status == 200
+        assert resp.read() == 'hello from /b'
+        for name in ['date', 'server']:
+            assert len(resp.msg.getallmatchingheaders(name)) == 1, name
+        h.request('GET', '/chunked')
+        resp = h.getresponse()
+        assert resp.getheader('transfer-encoding') is None
+        assert resp.read() == 'first second third'
+        h.request('GET', '/b')
+        resp = h.getresponse()
+        assert resp.status == 500
+        resp.read()
+
+    def testConcurrentKeepAlive(self):
+        from httplib import HTTPConnection
+        address = self._serve(match='sequence', cursor='connection')
+        errors = []
+        def replay():
+            try:
+                h = HTTPConnection(*address)
+                for path in self.paths:
+                    h.request('GET', path)
+                    body = h.getresponse().read()
+                    assert body.startswith('hello from') or \
+                        body == 'first second third'
+                    assert h.sock is not None
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target=replay) for i in range(24)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert not errors, errors
+
+
+class TestBench(unittest.TestCase):
+    def testRun(self):
+        from dalton.bench import run
+        results = run(only=['passthrough', 'playback'], quick=True)
+        names = set(result['benchmark'] for result in results)
+        assert names == set(['passthrough', 'playback'])
+        for result in results:
+            assert result['ops'] > 0
+            assert result['per_op_us'] >= 0
+
+
+class TestMaintenance(unittest.TestCase):
+    def setUp(self):
+        self.host, self.port = local_server()
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def _record(self, name, paths):
+        from httplib import HTTPConnection
+        h = HTTPConnection(self.host, self.port)
+        recorder = dalton.Recorder(caller=h)
+        with recorder.recording():
+            for path in paths:
+                h.request('GET', path)
+                h.getresponse().read()
+        path = os.path.join(self.root, name)
+        recorder.save(path)
+        return path
+
+    def testCompact(self):
+        from dalton.maintenance import compact_tree, find_recordings
+        first = self._record('first', ['/a', '/size/5000', '/size/5000',
+                                       '/b'])
+        os.mkdir(os.path.join(self.root, 'more'))
+        second = self._record(os.path.join('more', 'second'), ['/c'])
+        custom = self._record('custom', ['/d'])
+        with open(os.path.join(custom, '__init__.py'), 'a') as f:
+            f.write('\ndef helper():\n    pass\n')
+        broken = os.path.join(self.root, 'broken')
+        shutil.copytree(second, broken)
+        os.remove(os.path.join(broken, 'step_0_response.txt'))
+        assert find_recordings(self.root) == sorted([first, second, custom,
+                                                     broken])
+
+        results = compact_tree(self.root, processes=2, compression='zlib')
+        results = dict((result['recording'], result) for result in results)
+        assert results[first]['status'] == 'compacted'
+        assert results[first]['steps_before'] == 4
+        assert results[first]['steps_after'] == 4
+        assert results[first]['bytes_after'] < \
+            results[first]['bytes_before'] - 5000
+        assert results[second]['status'] == 'compacted'
+        assert results[custom]['status'] == 'skipped'
+        assert 'helper' in results[custom]['reason']
+        assert results[broken]['status'] == 'invalid'
+
+        dalton.clear_recording_cache()
+        steps = list(dalton.iter_steps(dalton.load_recording(first)))
+        assert [step.recorded_request['url'] for step in steps] == \
+            ['/a', '/size/5000', '/size/5000', '/b']
+        headers = dict(steps[0].recorded_response['headers'])
+        assert 'date' not in headers and 'content-type' in headers
+        body = steps[1].recorded_response['body']
+        assert body.compression == 'zlib' and body.load() == 'x' * 5000
+        assert not [name for name in os.listdir(self.root)
+                    if '.compacting' in name or '.precompact' in name]
+
+    def testDedupe(self):
+        from dalton.maintenance import compact_recording
+        path = self._record('dedupe', ['/a', '/poll', '/poll', '/b'])
+        result = compact_recording(path, dedupe=True)
+        assert result['steps_after'] == 3
+        dalton.clear_recording_cache()
+        steps = list(dalton.iter_steps(dalton.load_recording(path)))
+        assert [step.recorded_request['url'] for step in steps] == \
+            ['/a', '/poll', '/b']
+
+    def testOriginalFormat(self):
+        from dalton.maintenance import compact_recording
+        path = os.path.join(self.root, 'google_play_test')
+        shutil.copytree(os.path.join(here, 'test_recordings',
+                                     'google_play_test'), path)
+        result = compact_recording(path)
+        assert result['status'] == 'compacted', result
+        assert result['steps_after'] == 1
+        dalton.clear_recording_cache()
+        steps = list(dalton.iter_steps(dalton.load_recording(path)))
+        assert steps[0].recorded_request['url'] == '/'
+        headers = dict(steps[0].recorded_response['headers'])
+        assert 'set-cookie' not in headers and 'server' in headers
+
+    def testDryRun(self):
+        from dalton.command import main
+        path = self._record('dry', ['/size/5000'])
+        before = sorted(os.listdir(path))
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            main(['compact', '-n', '-j', '1', self.root])
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        assert sorted(os.listdir(path)) == before
+        assert '1 compacted' in output
+
+
+class TestVerify(unittest.TestCase):
+    def setUp(self):
+        self.host, self.port = local_server()
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def _record(self, name, paths):
+        from httplib import HTTPConnection
+        h = HTTPConnection(self.host, self.port)
+        recorder = dalton.Recorder(caller=h)
+        with recorder.recording():
+            for path in paths:
+                h.request('GET', path)
+                h.getresponse().read()
+            h.request('POST', '/form', body='q=dalton')
+            h.getresponse().read()
+        path = os.path.join(self.root, name)
+        recorder.save(path)
+        return path
+
+    def testVerify(self):
+        from dalton.verify import verify_recordings
+        same = self._record('same', ['/a', '/size/100'])
+        drifted = self._record('drifted', ['/b'])
+        with open(os.path.join(drifted, 'step_0_response.txt'), 'w') as f:
+            f.write('recorded long ago')
+        target = '%s:%s' % (self.host, self.port)
+        results = verify_recordings([same, drifted, self.root], target,
+                                    processes=2)
+        assert [result['status'] for result in results] == \
+            ['ok', 'drift', 'error']
+        assert results[0]['steps'] == 3
+        assert results[0]['latency_ms']['max'] >= \
+            results[0]['latency_ms']['p50'] > 0
+        assert results[0]['requests_per_sec'] > 0
+        drift = results[1]['drift']
+        assert [(d['step'], d['part']) for d in drift] == \
+            [('StepNumber0', 'body')]
+
+    def testCommand(self):
+        from dalton.command import main
+        self._record('same', ['/a'])
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            status = main(['verify', '-j', '1', '%s:%s' % (self.host,
+                                                           self.port),
+                           self.root])
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        assert status is None
+        assert '1 recordings verified' in output
+
+
 class TestGlobalRecorder(unittest.TestCase):
     def _makeHttp(self, host):
         from httplib import HTTPConnection
@@ -136,6 +1862,57 @@ class TestPlayer(unittest.TestCase):
 
 
 
+class TestLoadRecording(unittest.TestCase):
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        self.play_dir = os.path.join(here, 'test_recordings',
+                                     'google_play_test')
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def _copy(self, parent):
+        test_dir = os.path.join(self.output_dir, parent, 'recording')
+        shutil.copytree(self.play_dir, test_dir)
+        return test_dir
+
+    def testNoSysPath(self):
+        import sys
+        path = list(sys.path)
+        dalton.Player(playback_dir=self.play_dir, use_global=True)
+        assert sys.path == path
+
+    def testCached(self):
+        first = dalton.load_recording(self.play_dir)
+        assert dalton.load_recording(self.play_dir + os.path.sep) is first
+        assert first.StepNumber0.recorded_request['url'] == '/'
+
+    def testSameName(self):
+        first = self._copy('first')
+        second = self._copy('second')
+        with open(os.path.join(second, '__init__.py'), 'a') as f:
+            f.write('StepNumber0.recorded_request["url"] = "/second"\n')
+        assert dalton.load_recording(first).StepNumber0.recorded_request[
+            'url'] == '/'
+        assert dalton.load_recording(second).StepNumber0.recorded_request[
+            'url'] == '/second'
+
+    def testReloadChanged(self):
+        test_dir = self._copy('changed')
+        first = dalton.load_recording(test_dir)
+        with open(os.path.join(test_dir, '__init__.py'), 'a') as f:
+            f.write('StepNumber1 = None\n')
+        assert dalton.load_recording(test_dir) is not first
+
+    def testPreload(self):
+        self._copy('preload')
+        archive = os.path.join(self.output_dir, 'recording.dalton')
+        dalton.convert_recording(self.play_dir, archive)
+        dalton.clear_recording_cache()
+        assert dalton.preload_recordings(self.output_dir) == 2
+        assert len(dalton._recording_cache) == 2
+
+
 class TestGlobalPlayer(unittest.TestCase):
     def _makeHttp(self, host):
         from httplib import HTTPConnection
@@ -165,9 +1942,98 @@ class TestFileWrapper(unittest.TestCase):
         assert 'The document has moved' in content
         assert str(fw).startswith("FileWrapper('step_0_response.txt',")
     
+    def testOpen(self):
+        fw = dalton.FileWrapper('step_0_response.txt',
+            os.path.join(here, 'test_files'))
+        content = fw.load()
+        body = fw.open()
+        assert body._map is None
+        assert body.read(5) == content[:5]
+        assert str(body.readbuffer(5)) == content[5:10]
+        b = bytearray(5)
+        assert body.readinto(b) == 5
+        assert str(b) == content[10:15]
+        assert body.read() == content[15:]
+        assert body.read() == ''
+        body.close()
+        assert body.read() == ''
+
+    def testOpenRegion(self):
+        fw = dalton.FileWrapper('step_0_response.txt',
+            os.path.join(here, 'test_files'))
+        content = fw.load()
+        body = dalton.MappedBody(os.path.join(here, 'test_files',
+                                              'step_0_response.txt'), 10, 20)
+        assert body.read() == content[10:30]
+
+    def testCompression(self):
+        output_dir = tempfile.mkdtemp()
+        content = ''.join('line %s of the body\n' % i for i in range(5000))
+        try:
+            for compression in dalton.compression_suffixes:
+                fw = dalton.FileWrapper('body', output_dir, compression)
+                fw.write(StringIO.StringIO(content))
+                assert os.path.getsize(fw.path) < len(content) / 4
+                assert fw.load() == content
+                body = fw.open()
+                assert body.read(10) == content[:10]
+                b = bytearray(10)
+                assert body.readinto(b) == 10
+                assert str(b) == content[10:20]
+                assert len(body._buffer) < body.chunk_size * 20
+                assert body.read() == content[20:]
+                assert body.read(10) == ''
+                body.close()
+        finally:
+            shutil.rmtree(output_dir)
+
     def testSave(self):
         fw = dalton.FileWrapper('test_output.txt', 
             os.path.join(here, 'test_files'))
         fw.write('some_content')
         content = fw.load()
         assert 'some_content' == content
+
+
+class TestResponse(unittest.TestCase):
+    def _response_dict(self):
+        return {'headers': [('Content-Type', 'text/plain'),
+                            ('X-Count', '1'), ('x-count', '2')],
+                'status': 200, 'reason': 'OK', 'version': 11,
+                'body': 'the body'}
+
+    def testTemplate(self):
+        response_dict = self._response_dict()
+        first = dalton.create_response(response_dict)
+        second = dalton.create_response(response_dict)
+        assert first._template is second._template
+        assert first.read(3) == 'the'
+        assert second.read() == 'the body'
+        assert first.read() == ' body'
+
+        assert first.status == 200 and first.reason == 'OK'
+        assert first.getheader('content-type') == 'text/plain'
+        assert first.getheader('X-COUNT') == '2'
+        assert first.getheader('missing', 'x') == 'x'
+        assert first.getheaders() == [('content-type', 'text/plain'),
+                                      ('x-count', '2')]
+        assert sorted(first.msg.items()) == sorted(first.getheaders())
+        assert first.msg.getheader('x-count') == '2'
+
+        response_dict['status'] = 404
+        assert dalton.create_response(response_dict).status == 404
+
+    def testAttributes(self):
+        response = dalton.create_response(self._response_dict())
+        # urllib2 wraps responses by assigning recv
+        response.recv = response.read
+        assert response.recv() == 'the body'
+        response.msg = 'replaced'
+        assert response.msg == 'replaced'
+        self.assertRaises(AttributeError, setattr, response, 'other', 1)
+
+    def testNotReady(self):
+        import httplib
+        response = dalton.DaltonHTTPResponse()
+        self.assertRaises(httplib.ResponseNotReady, response.read)
+        assert response.getheader('content-type') is None
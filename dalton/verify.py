@@ -0,0 +1,144 @@
+"""Verify recordings against a live target
+
+Each recorded request is sent to the target (such as a stand-in server)
+and the live response is compared with the recorded one: the status,
+the ``headers`` asked for and a digest of the body. The recorded
+response is obtained by playing the request back with a
+:class:`dalton.Player`, so the recording's own ``handle_request``
+(and any :class:`dalton.Matcher`) is used just as in playback.
+
+Recordings are verified in parallel in a pool of worker processes,
+while the steps of one recording are sent in order over one connection.
+
+"""
+import hashlib
+import httplib
+import multiprocessing
+import time
+import urlparse
+
+import dalton
+
+
+def parse_target(target):
+    """Return the (host, port) of a ``host:port`` or ``http://`` URL
+    target"""
+    if '//' not in target:
+        target = 'http://' + target
+    parts = urlparse.urlsplit(target)
+    return parts.hostname, parts.port or 80
+
+
+def _content(body):
+    if isinstance(body, dalton.FileWrapper):
+        return body.load()
+    if isinstance(body, dalton.BodyDigest):
+        raise Exception("Only the digest of the request body was recorded.")
+    return body
+
+
+def _digest(content):
+    return hashlib.sha1(content).hexdigest() if content else None
+
+
+def _latency(latencies):
+    if not latencies:
+        return {}
+    ordered = sorted(latencies)
+    percentile = lambda p: ordered[min(int(len(ordered) * p),
+                                       len(ordered) - 1)]
+    return {'mean': sum(ordered) / len(ordered) * 1000.0,
+            'p50': percentile(0.5) * 1000.0,
+            'p95': percentile(0.95) * 1000.0,
+            'max': ordered[-1] * 1000.0}
+
+
+def verify_recording(recording, target, headers=('content-type',),
+                     matcher=None, timeout=30):
+    """Replay a recording's requests against the target
+
+    Returns a dict with the ``status`` (``'ok'``, ``'drift'`` or
+    ``'error'``), the number of ``steps`` sent, the ``drift`` found (a
+    list of dicts naming the step, the part that differs and both
+    values), and the throughput and latency (in milliseconds) of the
+    live requests.
+
+    """
+    headers = [name.lower() for name in headers]
+    result = {'recording': recording, 'steps': 0, 'drift': []}
+    latencies = []
+    start = time.time()
+    connection = None
+    try:
+        module = dalton.load_recording(recording)
+        player = dalton.Player(recording, use_global=True, matcher=matcher)
+        connection = httplib.HTTPConnection(*parse_target(target),
+                                            timeout=timeout)
+        for step in dalton.iter_steps(module):
+            recorded = step.recorded_request
+            method, url = recorded['method'], recorded['url']
+            body = _content(recorded['body'])
+            request_headers = dict(recorded['headers'] or {})
+
+            player.request(method, url, body, request_headers,
+                           host=recorded.get('host'))
+            response = player.getresponse()
+
+            sent = time.time()
+            connection.request(method, url, body, request_headers)
+            live = connection.getresponse()
+            live_body = live.read()
+            latencies.append(time.time() - sent)
+            result['steps'] += 1
+
+            expected = [('status', response.status, live.status)]
+            for name in headers:
+                expected.append(('header %s' % name,
+                                 response.getheader(name),
+                                 live.getheader(name)))
+            expected.append(('body', _digest(response.read()),
+                             _digest(live_body)))
+            response.close()
+            for part, was, now in expected:
+                if was != now:
+                    result['drift'].append({
+                        'step': step.__name__, 'method': method,
+                        'url': url, 'part': part, 'recorded': was,
+                        'live': now})
+    except Exception, e:
+        result['status'] = 'error'
+        result['error'] = '%s: %s' % (e.__class__.__name__, e)
+    else:
+        result['status'] = 'drift' if result['drift'] else 'ok'
+    finally:
+        if connection is not None:
+            connection.close()
+    seconds = time.time() - start
+    result['seconds'] = seconds
+    result['requests_per_sec'] = result['steps'] / seconds if seconds else 0
+    result['latency_ms'] = _latency(latencies)
+    return result
+
+
+def _verify(args):
+    recording, target, options = args
+    return verify_recording(recording, target, **options)
+
+
+def verify_recordings(recordings, target, processes=None, **options):
+    """Verify the recordings in a pool of ``processes`` worker
+    processes (one per CPU by default), returning their results in
+    order
+
+    The options are those of :func:`verify_recording`.
+
+    """
+    args = [(recording, target, options) for recording in recordings]
+    if processes == 1 or len(args) < 2:
+        return map(_verify, args)
+    pool = multiprocessing.Pool(processes)
+    try:
+        return pool.map(_verify, args, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
@@ -32,5 +32,7 @@ setup(name='dalton',
       ],
       entry_points="""
       # -*- Entry points: -*-
+      [console_scripts]
+      dalton = dalton.command:main
       """,
       )